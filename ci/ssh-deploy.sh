@@ -3,4 +3,7 @@ echo "${SSH_PRIVATE_KEY}" > ~/.ssh/id_ed25519
 ssh-keyscan -H -p 53185 ${SSH_HOST} > ~/.ssh/known_hosts
 ssh ssh://${SSH_USER}@${SSH_HOST}:53185 /usr/bin/docker compose --file /home/${SSH_USER}/syncthing/coruscant/compose.yaml pull yavin
 ssh ssh://${SSH_USER}@${SSH_HOST}:53185 /usr/bin/docker compose --file /home/${SSH_USER}/syncthing/coruscant/compose.yaml up --detach yavin
+# The worker uses the same image. Only restart it where the server's compose file
+# defines it (see "Background tasks" in README.md), so the app still deploys if not.
+ssh ssh://${SSH_USER}@${SSH_HOST}:53185 "if /usr/bin/docker compose --file /home/${SSH_USER}/syncthing/coruscant/compose.yaml config --services | grep --line-regexp --quiet yavin-worker; then /usr/bin/docker compose --file /home/${SSH_USER}/syncthing/coruscant/compose.yaml up --detach yavin-worker; else echo 'No yavin-worker service defined, skipping the worker'; fi"
 ssh ssh://${SSH_USER}@${SSH_HOST}:53185 /usr/bin/docker image prune --force
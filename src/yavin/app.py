@@ -1,22 +1,28 @@
+import dataclasses
 import datetime
 import decimal
 import functools
+import hashlib
 import logging
 import typing
 import urllib.parse
 import uuid
 
 import flask
-import httpx
 import jwt
 import pygal
 import waitress
+import werkzeug.exceptions
 import werkzeug.middleware.proxy_fix
 import werkzeug.utils
 
+import yavin.cache
 import yavin.components
 import yavin.db
 import yavin.db.app_sqlite
+import yavin.db.mirror
+import yavin.export
+import yavin.openid
 import yavin.settings
 import yavin.tasks
 import yavin.util
@@ -26,6 +32,9 @@ log = logging.getLogger(__name__)
 
 settings = yavin.settings.Settings()
 yavin.db.app_sqlite.connection_init(settings.database)
+openid = yavin.openid.Provider(
+    settings.openid_discovery_document, settings.openid_client_id
+)
 
 app = flask.Flask(__name__)
 app.wsgi_app = werkzeug.middleware.proxy_fix.ProxyFix(  # ty:ignore[invalid-assignment]
@@ -43,16 +52,37 @@ if settings.scheme == "https":
     app.config["SESSION_COOKIE_SECURE"] = True
 
 
+@functools.cache
+def get_db() -> yavin.db.YavinDatabase:
+    """Return the database handle shared by every request in this process. Requests
+    borrow connections from its pool and return them when each query finishes."""
+    return yavin.db.YavinDatabase(
+        settings.dsn,
+        maxconn=settings.web_server_threads,
+        max_age=settings.db_pool_max_age,
+        timeout=settings.db_pool_timeout,
+    )
+
+
+def _check_permission(permission: str) -> str | werkzeug.Response | None:
+    """Return the response for a user who lacks `permission`, or None if they have
+    it"""
+    app.logger.debug(f"Checking permission for {flask.g.email}")
+    if flask.g.email is None:
+        return flask.redirect(flask.url_for("index"))
+    if "admin" in flask.g.permissions or permission in flask.g.permissions:
+        return None
+    return yavin.components.not_authorized(flask.g.email, flask.g.permissions)
+
+
 def permission_required(permission: str) -> typing.Callable:
     def decorator(f: typing.Callable) -> typing.Callable:
         @functools.wraps(f)
         def decorated_function(*args, **kwargs) -> str | werkzeug.Response:  # noqa: ANN002, ANN003
-            app.logger.debug(f"Checking permission for {flask.g.email}")
-            if flask.g.email is None:
-                return flask.redirect(flask.url_for("index"))
-            if "admin" in flask.g.permissions or permission in flask.g.permissions:
-                return f(*args, **kwargs)
-            return yavin.components.not_authorized(flask.g.email, flask.g.permissions)
+            denied = _check_permission(permission)
+            if denied is not None:
+                return denied
+            return f(*args, **kwargs)
 
         return decorated_function
 
@@ -63,16 +93,60 @@ def permission_required(permission: str) -> typing.Callable:
 def before_request() -> None:
     log.debug(f"{flask.request.method} {flask.request.path}")
     flask.session.permanent = True
-    flask.g.db = yavin.db.YavinDatabase(settings.dsn)
+    flask.g.db = get_db()
     flask.g.settings = settings
     flask.g.app_settings = flask.g.db.settings_list()
     flask.g.email = flask.session.get("email", "")
     flask.g.permissions = flask.g.db.user_permissions_get(flask.g.email)
 
 
-@app.teardown_request
-def teardown_request(_: BaseException | None) -> None:
-    flask.g.db.p.closeall()
+@app.after_request
+def after_request(resp: flask.Response) -> flask.Response:
+    """Tag HTML responses with an ETag so browsers can revalidate them and get a 304
+    when nothing has changed"""
+    if (
+        flask.request.method == "GET"
+        and resp.status_code == 200
+        and resp.mimetype == "text/html"
+        and not resp.direct_passthrough
+        and not resp.is_streamed
+    ):
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+        if resp.get_etag() == (None, None):
+            resp.add_etag()
+        resp.make_conditional(flask.request)
+    return resp
+
+
+# (card id, required permission, endpoint that renders just this card)
+_dashboard_cards = [
+    ("balances", "balances", "dashboard_card_balances"),
+    ("billboard", "billboard", "dashboard_card_billboard"),
+    ("callings", "callings", "dashboard_card_callings"),
+    ("captains-log", "captains-log", "dashboard_card_captains_log"),
+    ("electricity", "electricity", "dashboard_card_electricity"),
+    ("expenses", "expenses", "dashboard_card_expenses"),
+    ("jar", "jar", "dashboard_card_jar"),
+    ("library", "library", "dashboard_card_library"),
+    ("mileage", "mileage", "dashboard_card_mileage"),
+    ("movie-night", "movie-night", "dashboard_card_movie_night"),
+    ("phone", "phone", "dashboard_card_phone"),
+    ("tithing", "tithing", "dashboard_card_tithing"),
+    ("weight", "weight", "dashboard_card_weight"),
+]
+
+
+def _visible_dashboard_cards() -> list[dict]:
+    return [
+        {
+            "id": card_id,
+            "url": flask.url_for(endpoint),
+            "visible": permission in flask.g.permissions
+            or "admin" in flask.g.permissions,
+        }
+        for card_id, permission, endpoint in _dashboard_cards
+    ]
 
 
 @app.get("/")
@@ -80,72 +154,18 @@ def index() -> str:
     session_email: str = flask.session.get("email", "")
     if session_email is None or session_email == "":
         return yavin.components.index_signed_out()
-    cards = [
-        {
-            "url": flask.url_for("dashboard_card_balances"),
-            "visible": "balances" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_billboard"),
-            "visible": "billboard" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_callings"),
-            "visible": "callings" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_captains_log"),
-            "visible": "captains-log" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_electricity"),
-            "visible": "electricity" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_expenses"),
-            "visible": "expenses" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_jar"),
-            "visible": "jar" in flask.g.permissions or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_library"),
-            "visible": "library" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_mileage"),
-            "visible": "mileage" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_movie_night"),
-            "visible": "movie-night" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_phone"),
-            "visible": "phone" in flask.g.permissions or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_tithing"),
-            "visible": "tithing" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-        {
-            "url": flask.url_for("dashboard_card_weight"),
-            "visible": "weight" in flask.g.permissions
-            or "admin" in flask.g.permissions,
-        },
-    ]
-    return yavin.components.index_signed_in(session_email, flask.g.permissions, cards)
+    key = (
+        "index",
+        session_email,
+        tuple(sorted(flask.g.permissions)),
+        flask.g.app_settings.get("debug_layout"),
+    )
+    return yavin.cache.fragments.get_or_render(
+        key,
+        lambda: yavin.components.index_signed_in(
+            session_email, flask.g.permissions, _visible_dashboard_cards()
+        ),
+    )
 
 
 @app.get("/app-settings")
@@ -186,13 +206,23 @@ def app_settings_update() -> werkzeug.Response:
         setting_value = "true" if setting_id in flask.request.values else "false"
         db.settings_update(setting_id, setting_value)
 
-    # Apply scheduled tasks setting immediately
-    scheduled_tasks_enabled = "scheduled_tasks_enabled" in flask.request.values
-    _manage_scheduled_tasks(scheduled_tasks_enabled)
+    # The worker picks up the scheduled tasks setting within a minute
 
     return flask.redirect(flask.url_for("app_settings"))
 
 
+@app.get("/app-status")
+@permission_required("admin")
+def app_status() -> dict:
+    db: yavin.db.YavinDatabase = flask.g.db
+    return {
+        "db_pool": dataclasses.asdict(db.p.stats()),
+        "caches": {k: dataclasses.asdict(v) for k, v in db.cache_stats().items()},
+        "fragments": dataclasses.asdict(yavin.cache.fragments.stats()),
+        "email_outbox": db.email_outbox_stats(),
+    }
+
+
 @app.get("/backdoor")
 def backdoor() -> werkzeug.Response:
     if settings.backdoor_enabled:
@@ -236,8 +266,7 @@ def balances_add_tx() -> werkzeug.Response:
 def billboard() -> str:
     flask.g.latest = flask.g.db.billboard_get_latest()
     if flask.g.latest is None:
-        yavin.tasks.billboard_number_one_fetch()
-        flask.g.latest = flask.g.db.billboard_get_latest()
+        yavin.tasks.enqueue(flask.g.db, "billboard_number_one_fetch")
     return yavin.components.billboard()
 
 
@@ -342,119 +371,167 @@ def captains_log_update() -> werkzeug.Response:
     return flask.redirect(flask.url_for("captains_log"))
 
 
+def _days_since_sustained(summary: dict) -> int | None:
+    """The callings card counts days, so the count has to be part of its cache key or
+    the text would stop changing once the card is cached"""
+    sustained_at = summary["callings_sustained_at"]
+    if sustained_at is None:
+        return None
+    return (yavin.util.today() - sustained_at).days
+
+
+# card id -> (component, arguments taken from the dashboard summary, summary section)
+# Cards without a section are static and never need the summary.
+_dashboard_card_renderers: dict[
+    str, tuple[typing.Callable[..., str], typing.Callable[[dict], tuple], str | None]
+] = {
+    "balances": (
+        yavin.components.dashboard_card_balances,
+        lambda s: (s["balances_accounts_count"],),
+        "balances",
+    ),
+    "billboard": (
+        yavin.components.dashboard_card_billboard,
+        lambda s: (s["billboard_artist"], s["billboard_title"]),
+        "billboard",
+    ),
+    "callings": (
+        yavin.components.dashboard_card_callings,
+        lambda s: (s["callings_calling"], _days_since_sustained(s)),
+        "callings",
+    ),
+    "captains-log": (yavin.components.dashboard_card_captains_log, lambda _: (), None),
+    "electricity": (yavin.components.dashboard_card_electricity, lambda _: (), None),
+    "expenses": (yavin.components.dashboard_card_expenses, lambda _: (), None),
+    "jar": (
+        yavin.components.dashboard_card_jar,
+        lambda s: (s["jar_days_since_last"],),
+        "jar",
+    ),
+    "library": (
+        yavin.components.dashboard_card_library,
+        lambda s: (s["library_books_count"], s["library_overdue_count"]),
+        "library",
+    ),
+    "mileage": (yavin.components.dashboard_card_mileage, lambda _: ("Go",), None),
+    "movie-night": (
+        yavin.components.dashboard_card_movie_night,
+        lambda s: (s["movie_night_next_pick"],),
+        "movie_night",
+    ),
+    "phone": (yavin.components.dashboard_card_phone, lambda _: (), None),
+    "tithing": (
+        yavin.components.dashboard_card_tithing,
+        lambda s: (s["tithing_owed"],),
+        "tithing",
+    ),
+    "weight": (
+        yavin.components.dashboard_card_weight,
+        lambda s: (s["weight_entry_date"], s["weight_weight"]),
+        "weight",
+    ),
+}
+
+
+def _render_dashboard_card(card_id: str, summary: dict) -> str:
+    """Render one dashboard card, reusing the cached HTML when the values it shows
+    have not changed"""
+    component, get_args, section = _dashboard_card_renderers[card_id]
+    args = get_args(summary)
+    key = ("dashboard-card", card_id, args, tuple(sorted(flask.g.permissions)))
+    tags = () if section is None else (f"dashboard:{section}",)
+    return yavin.cache.fragments.get_or_render(key, lambda: component(*args), tags)
+
+
+def _dashboard_card(card_id: str) -> flask.Response:
+    db: yavin.db.YavinDatabase = flask.g.db
+    summary = {}
+    if _dashboard_card_renderers[card_id][2] is not None:
+        summary = db.dashboard_summary()
+    resp = flask.make_response(_render_dashboard_card(card_id, summary))
+    resp.last_modified = summary.get("updated_at")
+    return resp
+
+
 @app.get("/dashboard-card/balances")
-def dashboard_card_balances() -> str:
-    accounts_count = flask.g.db.balances_accounts_count()
-    text = f"Accounts: {accounts_count}"
-    return yavin.components.dashboard_card_balances(text)
+def dashboard_card_balances() -> flask.Response:
+    return _dashboard_card("balances")
 
 
 @app.get("/dashboard-card/billboard")
-def dashboard_card_billboard() -> str:
-    latest = flask.g.db.billboard_get_latest()
-    if latest is None:
-        text = "Unknown"
-    else:
-        text = f"{latest.get('title')} by {latest.get('artist')}"
-    return yavin.components.dashboard_card_billboard(text)
+def dashboard_card_billboard() -> flask.Response:
+    return _dashboard_card("billboard")
 
 
 @app.get("/dashboard-card/callings")
-def dashboard_card_callings() -> str:
-    db: yavin.db.YavinDatabase = flask.g.db
-    callings = db.callings_list()
-    # Find the most recent calling that hasn't been released
-    current_calling = None
-    for calling in reversed(callings):
-        if calling.get("released_at") is None:
-            current_calling = calling
-            break
-    if current_calling is None and callings:
-        # If all are released, show the most recent one
-        current_calling = callings[-1]
-
-    if current_calling:
-        calling_name = current_calling["calling"]
-        sustained_at = current_calling["sustained_at"]
-        if sustained_at:
-            days = (yavin.util.today() - sustained_at).days
-            text = f"{calling_name}, {days} days"
-        else:
-            text = calling_name
-    else:
-        text = "No callings"
-
-    return yavin.components.dashboard_card_callings(text)
+def dashboard_card_callings() -> flask.Response:
+    return _dashboard_card("callings")
 
 
 @app.get("/dashboard-card/captains-log")
-def dashboard_card_captains_log() -> str:
-    return yavin.components.dashboard_card_captains_log()
+def dashboard_card_captains_log() -> flask.Response:
+    return _dashboard_card("captains-log")
 
 
 @app.get("/dashboard-card/electricity")
-def dashboard_card_electricity() -> str:
-    return yavin.components.dashboard_card_electricity()
+def dashboard_card_electricity() -> flask.Response:
+    return _dashboard_card("electricity")
 
 
 @app.get("/dashboard-card/expenses")
-def dashboard_card_expenses() -> str:
-    return yavin.components.dashboard_card_expenses()
+def dashboard_card_expenses() -> flask.Response:
+    return _dashboard_card("expenses")
 
 
 @app.get("/dashboard-card/jar")
-def dashboard_card_jar() -> str:
-    db: yavin.db.YavinDatabase = flask.g.db
-    days_since_last = db.jar_entries_days_since_last()
-    return yavin.components.dashboard_card_jar(days_since_last)
+def dashboard_card_jar() -> flask.Response:
+    return _dashboard_card("jar")
 
 
 @app.get("/dashboard-card/library")
-def dashboard_card_library() -> str:
-    db: yavin.db.YavinDatabase = flask.g.db
-    counts = db.library_books_count()
-    return yavin.components.dashboard_card_library(
-        counts["books_count"], counts["overdue_count"]
-    )
+def dashboard_card_library() -> flask.Response:
+    return _dashboard_card("library")
 
 
 @app.get("/dashboard-card/mileage")
-def dashboard_card_mileage() -> str:
-    return yavin.components.dashboard_card_mileage("Go")
+def dashboard_card_mileage() -> flask.Response:
+    return _dashboard_card("mileage")
 
 
 @app.get("/dashboard-card/movie-night")
-def dashboard_card_movie_night() -> str:
-    db: yavin.db.YavinDatabase = flask.g.db
-    next_pick = db.movie_people_next_pick()
-    if next_pick is None:
-        next_pick_person = "Unknown"
-    else:
-        next_pick_person = next_pick["person"]
-    return yavin.components.dashboard_card_movie_night(next_pick_person)
+def dashboard_card_movie_night() -> flask.Response:
+    return _dashboard_card("movie-night")
 
 
 @app.get("/dashboard-card/phone")
-def dashboard_card_phone() -> str:
-    return yavin.components.dashboard_card_phone()
+def dashboard_card_phone() -> flask.Response:
+    return _dashboard_card("phone")
 
 
 @app.get("/dashboard-card/tithing")
-def dashboard_card_tithing() -> str:
-    db: yavin.db.YavinDatabase = flask.g.db
-    tithing_owed = db.tithing_get_current_owed()
-    return yavin.components.dashboard_card_tithing(tithing_owed)
+def dashboard_card_tithing() -> flask.Response:
+    return _dashboard_card("tithing")
 
 
 @app.get("/dashboard-card/weight")
-def dashboard_card_weight() -> str:
+def dashboard_card_weight() -> flask.Response:
+    return _dashboard_card("weight")
+
+
+@app.get("/dashboard-cards")
+def dashboard_cards() -> flask.Response:
+    """Render every visible dashboard card in one response, reading the values for
+    all of them with one query"""
     db: yavin.db.YavinDatabase = flask.g.db
-    most_recent = db.weight_entries_get_most_recent()
-    if most_recent is None:
-        text = "No weight entries"
-    else:
-        text = f"{most_recent.get('weight')} on {most_recent.get('entry_date')}"
-    return yavin.components.dashboard_card_weight(text)
+    summary = db.dashboard_summary()
+    cards = [
+        {**card, "html": _render_dashboard_card(card["id"], summary)}
+        for card in _visible_dashboard_cards()
+        if card["visible"]
+    ]
+    resp = flask.make_response(yavin.components.dashboard_cards(cards))
+    resp.last_modified = summary.get("updated_at")
+    return resp
 
 
 @app.get("/electricity")
@@ -477,13 +554,18 @@ def electricity_add() -> werkzeug.Response:
     return flask.redirect(flask.url_for("electricity"))
 
 
-@app.get("/expenses")
-@permission_required("expenses")
-def expenses() -> str | werkzeug.Response:
+# Only accounts under this one are shown on the expenses page
+EXPENSES_ROOT = "Root Account:Expenses"
+
+
+def _expenses_db() -> yavin.db.ExpensesDatabase | None:
     ex_db_path = flask.g.app_settings.get("expenses_db")
     if ex_db_path is None:
-        return flask.redirect(flask.url_for("app_settings"))
-    ex_db = yavin.db.ExpensesDatabase(flask.g.app_settings.get("expenses_db"))
+        return None
+    return yavin.db.ExpensesDatabase.shared(ex_db_path)
+
+
+def _expenses_dates() -> tuple[datetime.date, datetime.date]:
     start_date = datetime.date(2000, 1, 1)
     end_date = datetime.date(2000, 1, 1)
     valid_start_date = False
@@ -519,15 +601,126 @@ def expenses() -> str | werkzeug.Response:
             log.debug(f"Dates are out of order, using {start_date} to {end_date}")
         else:
             log.debug(f"Both dates provided, using {start_date} to {end_date}")
+    return start_date, end_date
+
+
+def _expenses_account() -> str:
+    account = flask.request.values.get("account", EXPENSES_ROOT)
+    if account != EXPENSES_ROOT and not account.startswith(f"{EXPENSES_ROOT}:"):
+        raise werkzeug.exceptions.BadRequest("Not an expense account")
+    return account
+
+
+def _account_rollups(
+    account: str, totals: dict[str, decimal.Decimal]
+) -> tuple[decimal.Decimal, dict[str, decimal.Decimal]]:
+    """Roll account totals up to the direct subaccounts of `account`. Return what was
+    posted to `account` itself, and the total of each subaccount's subtree."""
+    direct = decimal.Decimal(0)
+    children: dict[str, decimal.Decimal] = {}
+    for name, amount in totals.items():
+        if name == account:
+            direct += amount
+        else:
+            child = f"{account}:{name[len(account) + 1 :].split(':')[0]}"
+            children[child] = children.get(child, 0) + amount
+    return direct, children
+
+
+@app.get("/expenses")
+@permission_required("expenses")
+def expenses() -> str | werkzeug.Response:
+    ex_db = _expenses_db()
+    if ex_db is None:
+        return flask.redirect(flask.url_for("app_settings"))
+    start_date, end_date = _expenses_dates()
     flask.g.start_date = start_date
     flask.g.end_date = end_date
-    flask.g.expenses = ex_db.get_expenses(
-        "Root Account:Expenses%", start_date, end_date
+    totals = ex_db.get_expense_totals(EXPENSES_ROOT, start_date, end_date, "account")
+    flask.g.total = sum(totals.values(), decimal.Decimal(0))
+    _, flask.g.categories = _account_rollups(EXPENSES_ROOT, totals)
+    flask.g.months = ex_db.get_expense_totals(
+        EXPENSES_ROOT, start_date, end_date, "month"
     )
-    flask.g.total = sum([e["amount"] for e in flask.g.expenses], 0)
     return yavin.components.expenses()
 
 
+@app.get("/expenses/accounts")
+@permission_required("expenses")
+def expenses_accounts() -> str:
+    ex_db = _expenses_db()
+    if ex_db is None:
+        raise werkzeug.exceptions.NotFound
+    start_date, end_date = _expenses_dates()
+    account = _expenses_account()
+    totals = ex_db.get_expense_totals(account, start_date, end_date, "account")
+    direct, children = _account_rollups(account, totals)
+    if not children:
+        rows = ex_db.get_expenses(account, start_date, end_date)
+        return yavin.components.expenses_rows(rows)
+    return yavin.components.expenses_accounts(
+        account, direct, children, start_date, end_date
+    )
+
+
+@app.get("/expenses/days")
+@permission_required("expenses")
+def expenses_days() -> str:
+    ex_db = _expenses_db()
+    if ex_db is None:
+        raise werkzeug.exceptions.NotFound
+    start_date, end_date = _expenses_dates()
+    days = ex_db.get_expense_totals(EXPENSES_ROOT, start_date, end_date, "day")
+    return yavin.components.expenses_days(days)
+
+
+@app.get("/expenses/rows")
+@permission_required("expenses")
+def expenses_rows() -> str:
+    ex_db = _expenses_db()
+    if ex_db is None:
+        raise werkzeug.exceptions.NotFound
+    start_date, end_date = _expenses_dates()
+    subaccounts = flask.request.values.get("direct") is None
+    rows = ex_db.get_expenses(_expenses_account(), start_date, end_date, subaccounts)
+    return yavin.components.expenses_rows(rows)
+
+
+@app.get("/export/<name>.<fmt>")
+def export(name: str, fmt: str) -> str | werkzeug.Response:
+    """Download a table, or expenses for a date range, as CSV or NDJSON. Rows are
+    streamed from the database in chunks, so memory use doesn't grow with the size
+    of the table."""
+    if fmt not in yavin.export.FORMATS:
+        raise werkzeug.exceptions.NotFound
+    if name == "expenses":
+        permission = "expenses"
+    elif name in yavin.export.TABLE_PERMISSIONS:
+        permission = yavin.export.TABLE_PERMISSIONS[name]
+    else:
+        raise werkzeug.exceptions.NotFound
+    denied = _check_permission(permission)
+    if denied is not None:
+        return denied
+    if name == "expenses":
+        ex_db = _expenses_db()
+        if ex_db is None:
+            raise werkzeug.exceptions.NotFound
+        start_date, end_date = _expenses_dates()
+        columns = yavin.export.EXPENSES_COLUMNS
+        chunks = ex_db.iter_expenses(EXPENSES_ROOT, start_date, end_date)
+        filename = f"expenses-{start_date}-{end_date}.{fmt}"
+    else:
+        columns = yavin.db.mirror.TABLES[name]
+        chunks = yavin.export.table_chunks(flask.g.db, name)
+        filename = f"{name}.{fmt}"
+    return flask.Response(
+        flask.stream_with_context(yavin.export.lines(fmt, columns, chunks)),
+        mimetype=yavin.export.FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @app.get("/favicon.svg")
 def favicon() -> flask.Response:
     return flask.Response(yavin.components.favicon(), mimetype="image/svg+xml")
@@ -540,7 +733,6 @@ def jar() -> str:
     flask.g.today = yavin.util.today()
     flask.g.days_since_last = db.jar_entries_days_since_last()
     app.logger.debug(f"Days since last jar entry: {flask.g.days_since_last}")
-    flask.g.jar_entries = db.jar_entries_list()
     return yavin.components.jar()
 
 
@@ -558,9 +750,15 @@ def jar_add() -> werkzeug.Response:
 @permission_required("jar")
 def jar_rows() -> str:
     db: yavin.db.YavinDatabase = flask.g.db
-    flask.g.page = int(flask.request.values.get("page", 1))
-    flask.g.rows = db.jar_entries_list(flask.g.page)
-    return yavin.components.jar_rows()
+    after = None
+    if "after_date" in flask.request.values:
+        after = (
+            yavin.util.str_to_date(flask.request.values["after_date"]),
+            int(flask.request.values["after_id"]),
+        )
+    # Ask for one extra row to find out whether there is another page
+    rows = db.jar_entries_list(limit=yavin.components.JAR_PAGE_SIZE + 1, after=after)
+    return yavin.components.jar_rows(rows)
 
 
 @app.get("/library")
@@ -568,7 +766,8 @@ def jar_rows() -> str:
 def library() -> str:
     db: yavin.db.YavinDatabase = flask.g.db
     library_books = db.library_books_list()
-    return yavin.components.library(library_books)
+    sync_status = db.task_requests_status("library_sync")
+    return yavin.components.library(library_books, sync_status)
 
 
 @app.get("/library/accounts")
@@ -591,7 +790,7 @@ def library_accounts_add() -> werkzeug.Response:
         "password": flask.request.form.get("password"),
     }
     db.library_credentials_insert(params)
-    yavin.tasks.scheduler.add_job(yavin.tasks.library_sync)
+    yavin.tasks.enqueue(db, "library_sync")
     return flask.redirect(flask.url_for("library_accounts"))
 
 
@@ -600,7 +799,7 @@ def library_accounts_add() -> werkzeug.Response:
 def library_accounts_delete() -> werkzeug.Response:
     db: yavin.db.YavinDatabase = flask.g.db
     db.library_credentials_delete(flask.request.form)
-    yavin.tasks.scheduler.add_job(yavin.tasks.library_sync)
+    yavin.tasks.enqueue(db, "library_sync")
     return flask.redirect(flask.url_for("library_accounts"))
 
 
@@ -608,7 +807,7 @@ def library_accounts_delete() -> werkzeug.Response:
 @permission_required("library")
 def library_notify_now() -> werkzeug.Response:
     log.info("Got library notification request")
-    yavin.tasks.scheduler.add_job(yavin.tasks.library_notify)
+    yavin.tasks.enqueue(flask.g.db, "library_notify")
     return flask.redirect(flask.url_for("library"))
 
 
@@ -616,107 +815,18 @@ def library_notify_now() -> werkzeug.Response:
 @permission_required("library")
 def library_sync_now() -> werkzeug.Response:
     log.info("Got library sync request")
-    yavin.tasks.scheduler.add_job(yavin.tasks.library_sync)
+    yavin.tasks.enqueue(flask.g.db, "library_sync")
     return flask.redirect(flask.url_for("library"))
 
 
 @app.get("/migrate")
+@permission_required("admin")
 def migrate() -> werkzeug.Response:
-    con = yavin.db.app_sqlite.connection_get(settings.database)
-    yavin.db.app_sqlite.migrate(con)
-    yavin.db.app_sqlite.reset_data(con)
-    for r in flask.g.db.balances_accounts_list():
-        yavin.db.app_sqlite.balances_accounts_insert(
-            con, r["account_name"], r["account_id"]
-        )
-    for r in flask.g.db.balances_transactions_list_all():
-        yavin.db.app_sqlite.balances_transactions_insert(
-            con,
-            r["account_id"],
-            r["tx_date"],
-            r["tx_description"],
-            r["tx_id"],
-            r["tx_value"],
-        )
-    for r in flask.g.db.billboard_list_all():
-        yavin.db.app_sqlite.billboard_insert(
-            con, r["artist"], r["fetched_at"], r["id"], r["title"]
-        )
-    for r in flask.g.db.callings_list():
-        yavin.db.app_sqlite.callings_insert(
-            con,
-            r["calling"],
-            r["id"],
-            r["released_at"],
-            r["set_apart_at"],
-            r["sustained_at"],
-            r["ward"],
-        )
-    for r in flask.g.db.electricity_list():
-        yavin.db.app_sqlite.electricity_insert(
-            con, r["bill"], r["bill_date"], r["charge"], r["kwh"]
-        )
-    for r in flask.g.db.hymn_history_list():
-        yavin.db.app_sqlite.hymn_history_insert(con, r["date"], r["hymn_number"])
-    for r in flask.g.db.hymn_tags_list():
-        yavin.db.app_sqlite.hymn_tags_insert(con, r["hymn_number"], r["tag"])
-    for r in flask.g.db.hymns_list():
-        yavin.db.app_sqlite.hymns_insert(
-            con, r["first_line"], r["hymn_number"], r["title"]
-        )
-    for r in flask.g.db.jar_entries_list_all():
-        yavin.db.app_sqlite.jar_entries_insert(con, r["entry_date"], r["id"], r["paid"])
-    for r in flask.g.db.library_books_list_all():
-        yavin.db.app_sqlite.library_books_insert(
-            con,
-            r["credential_id"],
-            r["due"],
-            r["id"],
-            r["item_id"],
-            r["medium"],
-            r["renewable"],
-            r["title"],
-        )
-    for r in flask.g.db.library_credentials_list():
-        yavin.db.app_sqlite.library_credentials_insert(
-            con,
-            r["balance"],
-            r["display_name"],
-            r["id"],
-            r["library"],
-            r["library_type"],
-            r["password"],
-            r["username"],
-        )
-    for r in flask.g.db.mileage_entries_list_all():
-        yavin.db.app_sqlite.mileage_entries_insert(con, r["entry_date"], r["mileage"])
-    for r in flask.g.db.movie_people_list():
-        yavin.db.app_sqlite.movie_people_insert(con, r["id"], r["person"])
-    for r in flask.g.db.movie_picks_list():
-        yavin.db.app_sqlite.movie_picks_insert(
-            con, r["id"], r["person_id"], r["pick_date"], r["pick_text"], r["pick_url"]
-        )
-    for r in flask.g.db.phone_usage_list():
-        yavin.db.app_sqlite.phone_usage_insert(
-            con,
-            r["end_date"],
-            r["id"],
-            r["megabytes"],
-            r["messages"],
-            r["minutes"],
-            r["start_date"],
-        )
-    for k, v in flask.g.db.settings_list().items():
-        yavin.db.app_sqlite.settings_insert(con, k, v)
-    for r in flask.g.db.tithing_income_list_all():
-        yavin.db.app_sqlite.tithing_income_insert(
-            con, r["amount"], r["date"], r["description"], r["id"], r["tithing_paid"]
-        )
-    for r in flask.g.db.user_permissions_list():
-        yavin.db.app_sqlite.user_permissions_insert(con, r.email, r.permissions_db)
-    for r in flask.g.db.weight_entries_list(limit=300):
-        yavin.db.app_sqlite.weight_entries_insert(con, r["entry_date"], r["weight"])
-    con.close()
+    log.info("Got SQLite export request")
+    if "full" in flask.request.values:
+        yavin.tasks.enqueue(flask.g.db, "mirror_export")
+    else:
+        yavin.tasks.enqueue(flask.g.db, "mirror_sync")
     return flask.redirect(flask.url_for("index"))
 
 
@@ -757,11 +867,24 @@ def mileage_delete() -> werkzeug.Response:
     return flask.redirect(flask.url_for("mileage"))
 
 
-@app.get("/mileage/svg")
-@permission_required("mileage")
-def mileage_svg() -> werkzeug.Response:
+# Mileage entries older than this many days are drawn one point per week
+MILEAGE_CHART_DAILY_DAYS = 365
+# Settings that the budget line on the mileage chart is drawn from
+MILEAGE_BUDGET_SETTINGS = (
+    "mileage_allowance",
+    "mileage_end_date",
+    "mileage_start",
+    "mileage_start_date",
+)
+
+
+def _mileage_chart(today: datetime.date) -> str:
     db: yavin.db.YavinDatabase = flask.g.db
-    entries = [(e["entry_date"], e["mileage"]) for e in db.mileage_entries_list_all()]
+    weekly_before = yavin.util.add_days(today, -MILEAGE_CHART_DAILY_DAYS)
+    entries = [
+        (e["entry_date"], e["mileage"])
+        for e in db.mileage_entries_list_for_chart(weekly_before)
+    ]
 
     start_date_str = flask.g.app_settings.get("mileage_start_date")
     end_date_str = flask.g.app_settings.get("mileage_end_date")
@@ -777,18 +900,48 @@ def mileage_svg() -> werkzeug.Response:
         start_mileage = int(start_mileage_str)
         allowance = int(allowance_str)
         daily_allowance = allowance // total_days.days
-        days_since_start = yavin.util.today() - start_date
+        days_since_start = today - start_date
         budget_today = days_since_start.days * daily_allowance
         chart.add(
             "Budget",
             [
                 (start_date, start_mileage),
-                (yavin.util.today(), start_mileage + budget_today),
+                (today, start_mileage + budget_today),
             ],
         )
 
     chart.add("Actual", entries)
-    return chart.render_response()
+    return chart.render(is_unicode=True)
+
+
+@app.get("/mileage/svg")
+@permission_required("mileage")
+def mileage_svg() -> werkzeug.Response:
+    """The chart only changes when an entry is added or deleted, a budget setting
+    changes, or the day changes, so it is rendered once for each of those and
+    browsers revalidate their copy with an ETag"""
+    db: yavin.db.YavinDatabase = flask.g.db
+    today = yavin.util.today()
+    key = (
+        "mileage-svg",
+        db.dashboard_summary().get("mileage_updated_at"),
+        tuple(flask.g.app_settings.get(s) for s in MILEAGE_BUDGET_SETTINGS),
+        today,
+        yavin.versions.app_version,
+    )
+    etag = hashlib.sha256(repr(key).encode()).hexdigest()
+
+    resp = flask.Response(mimetype="image/svg+xml")
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    resp.set_etag(etag)
+    # Don't render the chart just to throw it away for a 304
+    if etag not in flask.request.if_none_match:
+        svg = yavin.cache.fragments.get_or_render(
+            key, lambda: _mileage_chart(today), ("dashboard:mileage",)
+        )
+        resp.set_data(svg)
+    return resp.make_conditional(flask.request)
 
 
 @app.get("/movie-night")
@@ -953,8 +1106,7 @@ def authorize() -> werkzeug.Response:
         log.debug(f"{key}: {value}")
     if flask.session.get("state") != flask.request.values.get("state"):
         return flask.Response("State mismatch", 401)
-    discovery_document = httpx.get(settings.openid_discovery_document).json()
-    token_endpoint = discovery_document.get("token_endpoint")
+    token_endpoint = openid.discovery()["token_endpoint"]
     data = {
         "code": flask.request.values.get("code"),
         "client_id": settings.openid_client_id,
@@ -962,12 +1114,13 @@ def authorize() -> werkzeug.Response:
         "redirect_uri": flask.url_for("authorize", _external=True),
         "grant_type": "authorization_code",
     }
-    resp = httpx.post(token_endpoint, data=data).json()
+    resp = openid.http.post(token_endpoint, data=data).json()
     id_token = resp.get("id_token")
-    algorithms = discovery_document.get("id_token_signing_alg_values_supported")
-    claim = jwt.decode(
-        id_token, options={"verify_signature": False}, algorithms=algorithms
-    )
+    try:
+        claim = openid.decode_id_token(id_token)
+    except jwt.PyJWTError:
+        log.exception("Rejecting an ID token that failed verification")
+        return flask.Response("Invalid ID token", 401)
     flask.session["email"] = claim.get("email")
     return flask.redirect(flask.url_for("index"))
 
@@ -984,8 +1137,7 @@ def sign_in() -> werkzeug.Response:
         "redirect_uri": redirect_uri,
         "state": state,
     }
-    discovery_document = httpx.get(settings.openid_discovery_document).json()
-    auth_endpoint = discovery_document.get("authorization_endpoint")
+    auth_endpoint = openid.discovery().get("authorization_endpoint")
     auth_url = f"{auth_endpoint}?{urllib.parse.urlencode(query)}"
     return flask.redirect(auth_url, 307)
 
@@ -996,41 +1148,6 @@ def sign_out() -> werkzeug.Response:
     return flask.redirect(flask.url_for("index"))
 
 
-def _manage_scheduled_tasks(enabled: bool) -> None:
-    """Add or remove scheduled tasks based on the enabled flag."""
-    job_ids = ["billboard_fetch", "library_sync", "library_notify"]
-
-    # Remove existing jobs first to avoid duplicates
-    for job_id in job_ids:
-        job = yavin.tasks.scheduler.get_job(job_id)
-        if job:
-            yavin.tasks.scheduler.remove_job(job_id)
-
-    if enabled:
-        log.info("Adding scheduled tasks")
-        yavin.tasks.scheduler.add_job(
-            yavin.tasks.billboard_number_one_fetch,
-            "interval",
-            hours=24,
-            start_date=yavin.util.in_two_minutes(),
-            id="billboard_fetch",
-        )
-        yavin.tasks.scheduler.add_job(
-            yavin.tasks.library_sync,
-            "interval",
-            hours=6,
-            start_date=yavin.util.in_two_minutes(),
-            id="library_sync",
-        )
-        yavin.tasks.scheduler.add_job(
-            yavin.tasks.library_notify,
-            "cron",
-            day="*",
-            hour="3",
-            id="library_notify",
-        )
-
-
 def main() -> None:
     log.info(f"Welcome to Yavin {yavin.versions.app_version}")
     if settings.dsn == "":
@@ -1038,16 +1155,18 @@ def main() -> None:
             "Missing environment variable DSN; I cannot start without a database"
         )
     else:
-        db = yavin.db.YavinDatabase(settings.dsn)
+        db = get_db()
         db.migrate()
+        # Pick up anything that changed outside the app while it was stopped
+        db.dashboard_summary_refresh()
 
         if settings.admin_email:
             db.user_permissions_add(settings.admin_email, "admin")
 
-        yavin.tasks.scheduler.start()
-        _app_settings = db.settings_list()
-        scheduled_tasks_enabled = _app_settings.get("scheduled_tasks_enabled") == "true"
-        _manage_scheduled_tasks(scheduled_tasks_enabled)
+        # Scheduled and requested tasks run in the worker process (yavin-worker)
+
+        if settings.openid_discovery_document:
+            openid.prefetch()
 
         waitress.serve(
             app,
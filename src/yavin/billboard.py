@@ -1,33 +1,144 @@
+import argparse
 import collections
 import logging
+import pathlib
+import time
+from collections.abc import Iterable
 
 import httpx
+import lxml.etree
 import lxml.html
 
 log = logging.getLogger(__name__)
 
 Song = collections.namedtuple("Song", "artist title")
+# song is None when the chart hasn't changed since the validators were saved
+FetchResult = collections.namedtuple("FetchResult", "song etag last_modified")
 
+URL = "https://www.billboard.com/charts/hot-100/"
+# Bytes read from the response at a time while looking for the first chart item
+CHUNK_SIZE = 16 * 1024
+CHART_ITEM_CLASS = "o-chart-results-list__item"
 
-def fetch_number_one() -> Song:
-    log.info("Fetching Billboard Hot 100 #1")
-    url = "https://www.billboard.com/charts/hot-100/"
-    resp = httpx.get(url)
-    resp.raise_for_status()
-    doc = lxml.html.document_fromstring(resp.content)
 
-    title_el = doc.cssselect("li.o-chart-results-list__item h3")[0]
-    title = str(title_el.text_content()).strip()
+def _is_chart_item(el: lxml.etree._Element) -> bool:
+    return el.tag == "li" and CHART_ITEM_CLASS in (el.get("class") or "").split()
+
+
+def _text(el: lxml.etree._Element) -> str:
+    return str(el.xpath("string()")).strip()
+
 
+def _song(title_el: lxml.etree._Element) -> Song:
+    """The artist is the first span alongside the title"""
     title_parent = title_el.getparent()
-    artist_el = title_parent.cssselect("span")[0]
-    artist = str(artist_el.text_content()).strip()
-    return Song(artist, title)
+    spans = [] if title_parent is None else title_parent.cssselect("span")
+    if not spans:
+        raise ValueError("Could not find the artist of the #1 song")
+    return Song(_text(spans[0]), _text(title_el))
+
+
+def parse_number_one(chunks: Iterable[bytes]) -> Song:
+    """Find the first song in the Hot 100 page, feeding the parser one chunk at a time
+    and stopping as soon as the first chart item has been read"""
+    # Only the events needed to find the first chart item are reported
+    parser = lxml.etree.HTMLPullParser(events=("end",), tag=("h3", "li"))
+    title_el: lxml.etree._Element | None = None
+    chart_item: lxml.etree._Element | None = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for _, el in parser.read_events():
+            # Only end events are reported, and those are always elements
+            if not isinstance(el, lxml.etree._Element):
+                continue
+            if title_el is None:
+                if el.tag == "h3":
+                    chart_item = next(filter(_is_chart_item, el.iterancestors()), None)
+                    if chart_item is not None:
+                        title_el = el
+            # The artist follows the title, so wait for the whole chart item
+            elif el is chart_item:
+                return _song(title_el)
+    raise ValueError("Could not find the #1 song in the Hot 100 page")
+
+
+def parse_number_one_document(content: bytes) -> Song:
+    """Find the first song in the Hot 100 page by parsing the whole document"""
+    doc = lxml.html.document_fromstring(content)
+    return _song(doc.cssselect(f"li.{CHART_ITEM_CLASS} h3")[0])
+
+
+def fetch_number_one(
+    client: httpx.Client | None = None,
+    etag: str | None = None,
+    last_modified: str | None = None,
+) -> FetchResult:
+    """Fetch the Hot 100 #1. Pass the validators from the last fetch to skip the
+    download when the chart hasn't changed."""
+    log.info("Fetching Billboard Hot 100 #1")
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    if client is None:
+        with httpx.Client(follow_redirects=True) as client:
+            return _fetch(client, headers, etag, last_modified)
+    return _fetch(client, headers, etag, last_modified)
+
+
+def _fetch(
+    client: httpx.Client,
+    headers: dict[str, str],
+    etag: str | None,
+    last_modified: str | None,
+) -> FetchResult:
+    with client.stream("GET", URL, headers=headers) as resp:
+        if resp.status_code == httpx.codes.NOT_MODIFIED:
+            log.info("Billboard Hot 100 has not changed")
+            return FetchResult(None, etag, last_modified)
+        resp.raise_for_status()
+        song = parse_number_one(resp.iter_bytes(CHUNK_SIZE))
+        return FetchResult(
+            song, resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+        )
+
+
+def _benchmark(path: pathlib.Path, repeat: int) -> None:
+    content = path.read_bytes()
+    chunks = [content[i : i + CHUNK_SIZE] for i in range(0, len(content), CHUNK_SIZE)]
+    for name, parse in [
+        ("document", lambda: parse_number_one_document(content)),
+        ("streaming", lambda: parse_number_one(chunks)),
+    ]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            song = parse()
+        seconds = (time.perf_counter() - start) / repeat
+        log.info(f"{name}: {song} in {seconds * 1000:.2f}ms per parse")
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Get the Billboard Hot 100 #1")
+    parser.add_argument(
+        "--file",
+        type=pathlib.Path,
+        help="parse a saved copy of the Hot 100 page instead of fetching it",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="with --file, parse the page this many times with each parser and "
+        "report the average time",
+    )
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO)
-    log.info(fetch_number_one())
+    if args.file:
+        _benchmark(args.file, args.repeat)
+    else:
+        log.info(fetch_number_one())
 
 
 if __name__ == "__main__":
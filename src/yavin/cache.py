@@ -0,0 +1,173 @@
+import collections
+import dataclasses
+import threading
+import time
+from collections.abc import Callable, Hashable, Iterable
+
+
+@dataclasses.dataclass
+class CacheStats:
+    size: int
+    hits: int
+    misses: int
+    invalidations: int
+
+
+class TTLCache[K, V]:
+    """A small thread-safe in-process cache. Entries are dropped when they are
+    explicitly invalidated, or after `ttl` seconds so that several processes
+    sharing one database eventually agree.
+
+    Read generation() before loading a value and pass it to set(), so a value loaded
+    before an invalidation isn't cached after it."""
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._data: dict[K, tuple[float, V]] = {}
+        # Bumped by every invalidate() and clear(). Keys invalidated since the last
+        # clear() record the generation they were invalidated at.
+        self._generation = 0
+        self._cleared_at = 0
+        self._invalidated_at: dict[K, int] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._hits += 1
+                return entry[1]
+            self._data.pop(key, None)
+            self._misses += 1
+            return None
+
+    def _generation_of(self, key: K) -> int:
+        return self._invalidated_at.get(key, self._cleared_at)
+
+    def generation(self, key: K) -> int:
+        with self._lock:
+            return self._generation_of(key)
+
+    def set(self, key: K, value: V, generation: int | None = None) -> None:
+        """Cache `value`, unless `key` has been invalidated since `generation`"""
+        with self._lock:
+            if generation is not None and generation != self._generation_of(key):
+                return
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+            self._invalidated_at[key] = self._generation
+            self._invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self._cleared_at = self._generation
+            self._invalidated_at.clear()
+            self._invalidations += 1
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                size=len(self._data),
+                hits=self._hits,
+                misses=self._misses,
+                invalidations=self._invalidations,
+            )
+
+
+@dataclasses.dataclass
+class FragmentCacheStats:
+    size: int
+    bytes: int
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+
+
+class FragmentCache:
+    """A thread-safe LRU cache of rendered HTML fragments. The least recently used
+    fragments are evicted once the cached fragments take up more than `max_bytes`
+    when encoded as UTF-8.
+
+    Keys should include everything the fragment depends on (the component, the data
+    it shows, and the permissions of the user who sees it). Each fragment can also
+    carry tags, so a write can drop every fragment built from the data it touched."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        # Each fragment is kept with its tags and its size in bytes
+        self._data: collections.OrderedDict[
+            Hashable, tuple[str, frozenset[str], int]
+        ] = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def _pop(self, key: Hashable) -> None:
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def get_or_render(
+        self, key: Hashable, render: Callable[[], str], tags: Iterable[str] = ()
+    ) -> str:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+        html = render()
+        size = len(html.encode())
+        if size > self.max_bytes:
+            return html
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (html, frozenset(tags), size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._data)))
+                self._evictions += 1
+        return html
+
+    def invalidate_tag(self, tag: str) -> None:
+        with self._lock:
+            for key in [k for k, (_, tags, _) in self._data.items() if tag in tags]:
+                self._pop(key)
+            self._invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            self._invalidations += 1
+
+    def stats(self) -> FragmentCacheStats:
+        with self._lock:
+            return FragmentCacheStats(
+                size=len(self._data),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                invalidations=self._invalidations,
+            )
+
+
+# Rendered HTML shared by every request in the process
+fragments = FragmentCache(4 * 1024 * 1024)
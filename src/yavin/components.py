@@ -1,3 +1,4 @@
+import datetime
 import decimal
 import logging
 
@@ -12,6 +13,7 @@ import yavin.versions as v
 log = logging.getLogger(__name__)
 
 DECIMAL_ZERO = decimal.Decimal(0)
+JAR_PAGE_SIZE = 10
 
 
 def _back_to_balances() -> htpy.Element:
@@ -81,6 +83,18 @@ def _breadcrumb(href: str = "#", label: str = "Yavin") -> htpy.Element:
 _cdn = "https://cdn.jsdelivr.net/npm"
 
 
+def _dashboard_card_slot(card: dict, oob: bool = False) -> htpy.Element:
+    # Card HTML is rendered by the dashboard_card_* functions
+    card_html = card.get("html")
+    return htpy.div(
+        ".col",
+        hx_get=card.get("url"),
+        hx_swap_oob=oob and "true",
+        hx_trigger="refresh",
+        id=f"dashboard-card-{card.get('id')}",
+    )[card_html and markupsafe.Markup(card_html)]  # noqa: S704
+
+
 _debug_layout = [
     " ",
     htpy.span(".d-inline.d-sm-none")["xs"],
@@ -104,6 +118,18 @@ def _footer() -> htpy.Element:
     ]
 
 
+def _library_last_sync(cred: dict) -> htpy.Node:
+    synced_at = cred.get("last_synced_at")
+    if synced_at is None:
+        return "Never"
+    error = cred.get("last_sync_error")
+    return [
+        yavin.util.clean_datetime(synced_at),
+        htpy.small(".text-body-secondary")[f" ({cred.get('last_sync_seconds')}s)"],
+        error and htpy.div(".small.text-danger")[error],
+    ]
+
+
 def _page_title(title: str | markupsafe.Markup) -> htpy.Element:
     return htpy.div(".pt-3.row")[htpy.div(".col")[htpy.h1[title]]]
 
@@ -127,6 +153,9 @@ def _user_menu(email: str, is_admin: bool) -> htpy.Element:
                 htpy.a(".dropdown-item", href=flask.url_for("app_settings"))[
                     "App settings"
                 ],
+                htpy.a(".dropdown-item", href=flask.url_for("app_status"))[
+                    "App status"
+                ],
                 htpy.a(".dropdown-item", href=flask.url_for("user_permissions"))[
                     "User permissions"
                 ],
@@ -428,20 +457,26 @@ def balances_detail() -> str:
 
 
 def billboard() -> str:
+    if flask.g.latest is None:
+        latest = [htpy.p["Not fetched yet. Check back in a minute."]]
+    else:
+        latest = [
+            htpy.p[
+                htpy.strong[flask.g.latest.get("title")],
+                " by ",
+                flask.g.latest.get("artist"),
+            ],
+            htpy.p[
+                "Last fetched: ",
+                yavin.util.clean_datetime(flask.g.latest.get("fetched_at")),
+                " UTC",
+            ],
+        ]
     content = [
         _page_title("Billboard Hot 100 #1"),
         htpy.div(".pt-3.row")[
             htpy.div(".col")[
-                htpy.p[
-                    htpy.strong[flask.g.latest.get("title")],
-                    " by ",
-                    flask.g.latest.get("artist"),
-                ],
-                htpy.p[
-                    "Last fetched: ",
-                    yavin.util.clean_datetime(flask.g.latest.get("fetched_at")),
-                    " UTC",
-                ],
+                latest,
                 htpy.p[
                     htpy.a(
                         href="https://www.billboard.com/charts/hot-100/",
@@ -726,15 +761,24 @@ def dashboard_card(
     return str(content)
 
 
-def dashboard_card_balances(text: str) -> str:
-    return dashboard_card("Balances", flask.url_for("balances"), text)
+def dashboard_card_balances(accounts_count: int) -> str:
+    return dashboard_card(
+        "Balances", flask.url_for("balances"), f"Accounts: {accounts_count}"
+    )
 
 
-def dashboard_card_billboard(latest: str) -> str:
+def dashboard_card_billboard(artist: str | None, title: str | None) -> str:
+    latest = "Unknown" if title is None else f"{title} by {artist}"
     return dashboard_card("Billboard Hot 100 #1", flask.url_for("billboard"), latest)
 
 
-def dashboard_card_callings(text: str) -> str:
+def dashboard_card_callings(calling: str | None, days: int | None) -> str:
+    if calling is None:
+        text = "No callings"
+    elif days is not None:
+        text = f"{calling}, {days} days"
+    else:
+        text = calling
     return dashboard_card("Callings", flask.url_for("callings"), text)
 
 
@@ -770,9 +814,11 @@ def dashboard_card_mileage(text: str) -> str:
     return dashboard_card("Mileage", flask.url_for("mileage"), text)
 
 
-def dashboard_card_movie_night(next_pick: str) -> str:
+def dashboard_card_movie_night(next_pick: str | None) -> str:
     return dashboard_card(
-        "Movie night", flask.url_for("movie_night"), f"Next pick: {next_pick}"
+        "Movie night",
+        flask.url_for("movie_night"),
+        f"Next pick: {next_pick or 'Unknown'}",
     )
 
 
@@ -785,10 +831,19 @@ def dashboard_card_tithing(tithing_owed: decimal.Decimal) -> str:
     return dashboard_card("Tithing", flask.url_for("tithing"), card_text)
 
 
-def dashboard_card_weight(text: str) -> str:
+def dashboard_card_weight(
+    entry_date: datetime.date | None, weight: decimal.Decimal | None
+) -> str:
+    text = "No weight entries" if entry_date is None else f"{weight} on {entry_date}"
     return dashboard_card("Weight", flask.url_for("weight"), text)
 
 
+def dashboard_cards(cards: list[dict]) -> str:
+    """Render every card as an out-of-band swap, so a single response can fill in
+    all the placeholders on the dashboard"""
+    return str(htpy.fragment[(_dashboard_card_slot(card, oob=True) for card in cards)])
+
+
 def electricity() -> str:
     rows = [
         htpy.tr[
@@ -933,31 +988,133 @@ def email_library_item_due(due_books: list[dict]) -> str:
     return str(content)
 
 
-def expenses() -> str:
-    expense_rows = [
-        htpy.tr[
-            htpy.td[
-                htpy.div(".g-1.justify-content-between.row")[
-                    htpy.div(".col-auto")[
-                        e["description"],
-                        htpy.br,
-                        e["memo"] and htpy.small[e["memo"]],
-                    ],
-                    htpy.div(".col-auto.text-end")[
-                        htpy.strong["$ ", f"{e['amount']:,.2f}"]
-                    ],
+def _expense_row(e: dict) -> htpy.Element:
+    return htpy.tr[
+        htpy.td[
+            htpy.div(".g-1.justify-content-between.row")[
+                htpy.div(".col-auto")[
+                    e["description"],
+                    htpy.br,
+                    e["memo"] and htpy.small[e["memo"]],
                 ],
-                htpy.div(".g-1.justify-content-between.row")[
-                    htpy.div(".col-auto")[
-                        htpy.span(".badge.bg-primary")[e["account"][13:]]
-                    ],
-                    htpy.div(".col-auto.text-body-secondary.text-end")[
-                        e["post_date"][:10]
-                    ],
+                htpy.div(".col-auto.text-end")[
+                    htpy.strong["$ ", f"{e['amount']:,.2f}"]
+                ],
+            ],
+            htpy.div(".g-1.justify-content-between.row")[
+                htpy.div(".col-auto")[
+                    htpy.span(".badge.bg-primary")[e["account"][13:]]
+                ],
+                htpy.div(".col-auto.text-body-secondary.text-end")[e["post_date"][:10]],
+            ],
+        ]
+    ]
+
+
+def _expense_total_row(
+    label: str, amount: decimal.Decimal, url: str, depth: int = 0
+) -> htpy.Element:
+    """A total that loads its breakdown below itself the first time it is clicked"""
+    return htpy.tr(
+        hx_get=url, hx_swap="afterend", hx_trigger="click once", role="button"
+    )[
+        htpy.td(style=f"padding-left: {depth + 0.5}rem")[
+            htpy.div(".g-1.justify-content-between.row")[
+                htpy.div(".col-auto")[
+                    label,
+                    " ",
+                    htpy.span(".htmx-indicator.spinner-border.spinner-border-sm"),
                 ],
+                htpy.div(".col-auto.text-end")[f"$ {amount:,.2f}"],
+            ]
+        ]
+    ]
+
+
+def _expense_account_url(
+    account: str,
+    start_date: datetime.date,
+    end_date: datetime.date,
+    direct: bool = False,
+) -> str:
+    endpoint = "expenses_rows" if direct else "expenses_accounts"
+    return flask.url_for(
+        endpoint,
+        account=account,
+        direct=direct or None,
+        start_date=start_date.isoformat(),
+        end_date=end_date.isoformat(),
+    )
+
+
+def expenses_accounts(
+    account: str,
+    direct: decimal.Decimal,
+    children: dict[str, decimal.Decimal],
+    start_date: datetime.date,
+    end_date: datetime.date,
+) -> str:
+    depth = account.count(":")
+    rows = []
+    if direct:
+        # Splits posted to the account itself, not to one of its subaccounts
+        label = f"{account.rsplit(':', 1)[-1]} (other)"
+        url = _expense_account_url(account, start_date, end_date, direct=True)
+        rows.append(_expense_total_row(label, direct, url, depth))
+    for child, amount in children.items():
+        label = child.rsplit(":", 1)[-1]
+        url = _expense_account_url(child, start_date, end_date)
+        rows.append(_expense_total_row(label, amount, url, depth))
+    return str(htpy.fragment[rows])
+
+
+def expenses_days(days: dict[str, decimal.Decimal]) -> str:
+    rows = [
+        _expense_total_row(
+            day,
+            amount,
+            flask.url_for("expenses_rows", start_date=day, end_date=day),
+            depth=1,
+        )
+        for day, amount in days.items()
+    ]
+    return str(htpy.fragment[rows])
+
+
+def expenses_rows(rows: list[dict]) -> str:
+    return str(htpy.fragment[(_expense_row(e) for e in rows)])
+
+
+def expenses() -> str:
+    start_date = flask.g.start_date
+    end_date = flask.g.end_date
+    category_rows = [
+        _expense_total_row(
+            category.rsplit(":", 1)[-1],
+            amount,
+            _expense_account_url(category, start_date, end_date),
+        )
+        for category, amount in flask.g.categories.items()
+    ]
+    month_rows = []
+    for month, amount in flask.g.months.items():
+        month_start = datetime.date.fromisoformat(f"{month}-01")
+        month_end = yavin.util.add_days(
+            (month_start + datetime.timedelta(days=31)).replace(day=1), -1
+        )
+        url = flask.url_for(
+            "expenses_days",
+            start_date=max(start_date, month_start).isoformat(),
+            end_date=min(end_date, month_end).isoformat(),
+        )
+        month_rows.append(_expense_total_row(month, amount, url))
+    total_row = htpy.tr[
+        htpy.td[
+            htpy.div(".g-1.justify-content-between.row")[
+                htpy.div(".col-auto")[htpy.strong["Total"]],
+                htpy.div(".col-auto")[htpy.strong["$ ", f"{flask.g.total:,.2f}"]],
             ]
         ]
-        for e in flask.g.expenses
     ]
     content = [
         _page_title("Expenses"),
@@ -999,20 +1156,12 @@ def expenses() -> str:
         htpy.div(".pt-3.row")[
             htpy.div(".col.col-sm-8.col-md-6.col-lg-5.col-xl-4.col-xxl-3")[
                 htpy.table(".table.table-striped")[
-                    htpy.tbody[
-                        htpy.tr[
-                            htpy.td[
-                                htpy.div(".g-1.justify-content-between.row")[
-                                    htpy.div(".col-auto")[htpy.strong["Total"]],
-                                    htpy.div(".col-auto")[
-                                        htpy.strong["$ ", f"{flask.g.total:,.2f}"]
-                                    ],
-                                ]
-                            ]
-                        ],
-                        expense_rows,
-                    ]
-                ]
+                    htpy.tbody[total_row, category_rows]
+                ],
+                htpy.table(".table.table-striped")[
+                    htpy.thead[htpy.tr[htpy.th["By month"]]],
+                    htpy.tbody[month_rows],
+                ],
             ]
         ],
     ]
@@ -1047,14 +1196,11 @@ def favicon() -> str:
 
 def index_signed_in(email: str, permissions: list[str], cards: list[dict]) -> str:
     content = htpy.div(
-        ".g-2.pt-3.row.row-cols-2.row-cols-md-3.row-cols-lg-4.row-cols-xl-5.row-cols-xxl-6"
-    )[
-        (
-            htpy.div(".col", hx_get=card.get("url"), hx_trigger="load")
-            for card in cards
-            if card.get("visible")
-        )
-    ]
+        ".g-2.pt-3.row.row-cols-2.row-cols-md-3.row-cols-lg-4.row-cols-xl-5.row-cols-xxl-6",
+        hx_get=flask.url_for("dashboard_cards"),
+        hx_swap="none",
+        hx_trigger="load",
+    )[(_dashboard_card_slot(card) for card in cards if card.get("visible"))]
     return signed_in(email, permissions, _breadcrumb(), content, "Yavin")
 
 
@@ -1112,29 +1258,51 @@ def jar() -> str:
     )
 
 
-def jar_rows() -> str:
-    rows = []
-    for i, r in enumerate(flask.g.rows):
-        if i < 11:
-            rows.append(htpy.tr[htpy.td[r.get("entry_date").isoformat()]])
-        else:
-            rows.append(
-                htpy.tr[
-                    htpy.td(
-                        ".py-3.text-center",
-                        hx_post=flask.url_for("jar_rows", page=flask.g.page + 1),
-                        hx_swap="outerHTML",
-                        hx_target="closest tr",
-                        hx_trigger="revealed",
-                    )[htpy.span(".htmx-indicator.spinner-border.spinner-border-sm")]
-                ]
-            )
+def jar_rows(records: list[dict]) -> str:
+    page = records[:JAR_PAGE_SIZE]
+    rows = [htpy.tr[htpy.td[r["entry_date"].isoformat()]] for r in page]
+    if len(records) > JAR_PAGE_SIZE:
+        last = page[-1]
+        rows.append(
+            htpy.tr[
+                htpy.td(
+                    ".py-3.text-center",
+                    hx_post=flask.url_for(
+                        "jar_rows",
+                        after_date=last["entry_date"].isoformat(),
+                        after_id=last["id"],
+                    ),
+                    hx_swap="outerHTML",
+                    hx_target="closest tr",
+                    hx_trigger="revealed",
+                )[htpy.span(".htmx-indicator.spinner-border.spinner-border-sm")]
+            ]
+        )
     if not rows:
         rows.append(htpy.tr(".text-center")[htpy.td["No entries found."]])
     return str(htpy.fragment[rows])
 
 
-def library(library_books: list[dict]) -> str:
+def _library_sync_status(sync_status: dict) -> htpy.Node:
+    lines = []
+    if sync_status.get("running"):
+        lines.append("Sync running")
+    elif sync_status.get("queued"):
+        lines.append("Sync queued")
+    if sync_status.get("last_finished_at") is not None:
+        finished_at = yavin.util.clean_datetime(sync_status["last_finished_at"])
+        seconds = sync_status.get("last_seconds")
+        lines.append(f"Last sync finished {finished_at}, took {seconds}s")
+        if sync_status.get("last_error"):
+            lines.append(f"Last sync failed: {sync_status['last_error']}")
+    if not lines:
+        return None
+    return htpy.p(".small.text-body-secondary")[
+        [[htpy.br if i else None, line] for i, line in enumerate(lines)]
+    ]
+
+
+def library(library_books: list[dict], sync_status: dict) -> str:
     content = [
         _page_title("Library"),
         htpy.div(".pt-3.row")[
@@ -1149,6 +1317,7 @@ def library(library_books: list[dict]) -> str:
                     ".btn.btn-primary.mb-2.me-1",
                     href=flask.url_for("library_notify_now"),
                 )[htpy.i(".bi-bell"), " Notify now"],
+                _library_sync_status(sync_status),
             ]
         ],
         htpy.div(".pt-3.row")[
@@ -1189,6 +1358,7 @@ def library_accounts() -> str:
             htpy.td[cred.get("username")],
             htpy.td["***"],
             htpy.td[cred.get("balance"), markupsafe.Markup("&cent;")],
+            htpy.td[_library_last_sync(cred)],
             htpy.td[
                 htpy.form(
                     action=flask.url_for("library_accounts_delete"), method="post"
@@ -1261,6 +1431,7 @@ def library_accounts() -> str:
             )
         ],
         htpy.td,
+        htpy.td,
         htpy.td[
             htpy.button(".btn.btn-success", form="form-add-library", type="submit")[
                 htpy.i(".bi-plus-circle")
@@ -1280,6 +1451,7 @@ def library_accounts() -> str:
                             htpy.th["Username"],
                             htpy.th["Password"],
                             htpy.th["Balance"],
+                            htpy.th["Last sync"],
                             htpy.th["Actions"],
                         ]
                     ],
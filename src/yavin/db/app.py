@@ -1,19 +1,119 @@
 import dataclasses
 import datetime
 import decimal
+import json
 import logging
 import uuid
+from collections.abc import Iterable, Iterator
 from typing import TypedDict, cast
 
 import fort
+import psycopg2
+import psycopg2.extras
+
+import yavin.cache
+import yavin.db.pool
 
 log = logging.getLogger(__name__)
 
+# The web server and the worker both migrate at startup, holding this advisory lock
+MIGRATION_LOCK_ID = 7_955_570_111
+
+# Settings and user permissions are read on every request but almost never change.
+# These caches are shared by every YavinDatabase in the process.
+_settings_cache: yavin.cache.TTLCache[str, dict[str, str]] = yavin.cache.TTLCache(60)
+_user_permissions_cache: yavin.cache.TTLCache[str, list[str]] = yavin.cache.TTLCache(60)
+
+
+def _days_since(last_entry: datetime.date | None) -> int:
+    if last_entry is None:
+        return -1
+    if last_entry > datetime.date.today():
+        return 0
+    return (datetime.date.today() - last_entry).days
+
+
+# Each section of the dashboard_summary table, and the assignment that recomputes it
+_dashboard_summary_sections = {
+    "balances": """
+        balances_accounts_count = (select count(*) from balances_accounts)
+    """,
+    "billboard": """
+        (billboard_artist, billboard_title) = (
+            select artist, title
+            from billboard_number_one
+            order by fetched_at desc
+            limit 1
+        )
+    """,
+    "callings": """
+        (callings_calling, callings_sustained_at) = (
+            select calling, sustained_at
+            from callings
+            order by released_at is null desc, sustained_at desc
+            limit 1
+        )
+    """,
+    "jar": """
+        jar_last_entry = (select max(entry_date) from jar_entries)
+    """,
+    "library": """
+        (library_books_count, library_due_dates) = (
+            select count(*), coalesce(array_agg(due order by due), '{}')
+            from library_books
+        )
+    """,
+    # Mileage entries are only ever drawn in full, so just note when they change
+    "mileage": """
+        mileage_updated_at = current_timestamp
+    """,
+    "movie_night": """
+        movie_night_next_pick = (
+            select m.person
+            from movie_people m
+            left join (
+                select person_id, max(pick_date) last_pick_date
+                from movie_picks
+                group by person_id
+            ) l on l.person_id = m.id
+            order by l.last_pick_date nulls first, m.id
+            limit 1
+        )
+    """,
+    "tithing": """
+        tithing_owed = (
+            select round(coalesce(sum(amount), 0) * 0.1, 2)
+            from tithing_income
+            where tithing_paid is null
+        )
+    """,
+    "weight": """
+        (weight_entry_date, weight_weight) = (
+            select entry_date, weight
+            from weight_entries
+            order by entry_date desc
+            limit 1
+        )
+    """,
+}
+
+
+def _dashboard_summary_update(sections: Iterable[str]) -> str:
+    """The statement that recomputes `sections` of the dashboard_summary table"""
+    assignments = [_dashboard_summary_sections[section] for section in sections]
+    return f"""
+        update dashboard_summary
+        set {", ".join(assignments)}, updated_at = current_timestamp
+        where id = 1
+    """  # noqa: S608
+
 
 class BillboardRow(TypedDict):
     artist: str
+    etag: str | None
     fetched_at: datetime.datetime
     id: uuid.UUID
+    last_modified: str | None
     title: str
 
 
@@ -21,6 +121,9 @@ class LibraryCredential(TypedDict):
     balance: int
     display_name: str
     id: uuid.UUID
+    last_sync_error: str | None
+    last_sync_seconds: decimal.Decimal | None
+    last_synced_at: datetime.datetime | None
     library: str
     library_type: str
     password: str
@@ -40,6 +143,76 @@ class UserPermissions:
 class YavinDatabase(fort.PostgresDatabase):
     _version: int = -1
 
+    def __init__(
+        self,
+        dsn: str,
+        minconn: int = 1,
+        maxconn: int = 1,
+        max_age: float = 1800.0,
+        timeout: float = 30.0,
+    ) -> None:
+        # fort.PostgresDatabase.__init__ would open a ThreadedConnectionPool, which
+        # fails instead of waiting when it is exhausted. Use our own pool instead.
+        self.log = logging.getLogger(fort.PostgresDatabase.__module__)
+        self.p: yavin.db.pool.ConnectionPool = yavin.db.pool.ConnectionPool(
+            minconn,
+            maxconn,
+            dsn,
+            max_age=max_age,
+            timeout=timeout,
+            cursor_factory=psycopg2.extras.DictCursor,
+        )
+        psycopg2.extras.register_uuid()
+
+    def cache_stats(self) -> dict[str, yavin.cache.CacheStats]:
+        return {
+            "settings": _settings_cache.stats(),
+            "user_permissions": _user_permissions_cache.stats(),
+        }
+
+    def q_iter(
+        self, sql: str, params: dict | None = None, chunk_size: int = 1000
+    ) -> Iterator[list[psycopg2.extras.DictRow]]:
+        """Execute a query with a server-side cursor and yield the rows in chunks of
+        up to `chunk_size`, so large results never have to fit in memory at once. The
+        connection stays checked out of the pool until the generator is exhausted or
+        closed."""
+        if params is None:
+            params = {}
+        cnx = self.p.getconn()
+        try:
+            with cnx:
+                with cnx.cursor(name=f"q_iter_{uuid.uuid4().hex}") as c:
+                    c.itersize = chunk_size
+                    c.execute(sql, params)
+                    while chunk := c.fetchmany(chunk_size):
+                        yield chunk
+        finally:
+            self.p.putconn(cnx)
+
+    def u_summary(
+        self, section: str, sql: str, params: dict | None = None
+    ) -> dict | None:
+        """Execute a write and recompute the dashboard summary section it affects in
+        the same transaction, so the summary can't be left out of date if the process
+        dies between them. Returns the first row the write returns, if any."""
+        if params is None:
+            params = {}
+        cnx = self.p.getconn()
+        try:
+            with cnx:
+                with cnx.cursor() as c:
+                    # Writers that touch the summary take turns, so each recomputes
+                    # it after the previous one has committed
+                    c.execute("select from dashboard_summary where id = 1 for update")
+                    c.execute(sql, params)
+                    row = c.fetchone() if c.description else None
+                    c.execute(_dashboard_summary_update([section]))
+        finally:
+            self.p.putconn(cnx)
+        yavin.cache.fragments.invalidate_tag(f"dashboard:{section}")
+        return row
+
     # balances
 
     def balances_accounts_count(self) -> int:
@@ -101,29 +274,38 @@ class YavinDatabase(fort.PostgresDatabase):
 
     # billboard
 
-    def billboard_get_latest(self) -> BillboardRow:
+    def billboard_get_latest(self) -> BillboardRow | None:
         sql = """
-            select artist, fetched_at, id, title
+            select artist, etag, fetched_at, id, last_modified, title
             from billboard_number_one
             order by fetched_at desc
             limit 1
         """
-        return cast(BillboardRow, cast(object, self.q_one(sql)))
+        return cast(BillboardRow | None, cast(object, self.q_one(sql)))
 
-    def billboard_insert(self, artist: str, title: str) -> None:
+    def billboard_insert(
+        self,
+        artist: str,
+        title: str,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> None:
         sql = """
             insert into billboard_number_one (
-                artist, fetched_at, id, title
+                artist, etag, fetched_at, id, last_modified, title
             ) values (
-                %(artist)s, current_timestamp, %(id)s, %(title)s
+                %(artist)s, %(etag)s, current_timestamp, %(id)s, %(last_modified)s,
+                %(title)s
             )
         """
         params = {
             "artist": artist,
+            "etag": etag,
             "id": uuid.uuid4(),
+            "last_modified": last_modified,
             "title": title,
         }
-        self.u(sql, params)
+        self.u_summary("billboard", sql, params)
 
     def billboard_list_all(self) -> list[BillboardRow]:
         sql = """
@@ -132,17 +314,39 @@ class YavinDatabase(fort.PostgresDatabase):
         """
         return cast(list[BillboardRow], cast(object, self.q(sql)))
 
-    def billboard_update_fetched_at(self, _id: uuid.UUID) -> None:
+    def billboard_update_fetched_at(
+        self,
+        _id: uuid.UUID,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> None:
+        """Record that the latest #1 was fetched again and hasn't changed, along with
+        the validators for the next conditional fetch"""
         sql = """
             update billboard_number_one
-            set fetched_at = current_timestamp
+            set fetched_at = current_timestamp,
+                etag = %(etag)s,
+                last_modified = %(last_modified)s
             where id = %(id)s
         """
         params = {
+            "etag": etag,
             "id": _id,
+            "last_modified": last_modified,
         }
         self.u(sql, params)
 
+    def callings_get_current(self) -> dict | None:
+        """Get the most recent calling that hasn't been released. If all callings
+        have been released, get the most recent one."""
+        sql = """
+            select id, ward, calling, sustained_at, set_apart_at, released_at
+            from callings
+            order by released_at is null desc, sustained_at desc
+            limit 1
+        """
+        return self.q_one(sql)
+
     def callings_insert(self, params: dict) -> None:
         sql = """
             insert into callings (
@@ -153,7 +357,7 @@ class YavinDatabase(fort.PostgresDatabase):
                 %(released_at)s
             )
         """
-        self.u(sql, params)
+        self.u_summary("callings", sql, params)
 
     def callings_list(self) -> list[dict]:
         sql = """
@@ -204,14 +408,23 @@ class YavinDatabase(fort.PostgresDatabase):
         }
         self.u(sql, params)
 
-    def captains_log_list(self, limit: int = 20) -> list[dict]:
-        sql = """
+    def captains_log_list(
+        self, limit: int = 20, after: tuple[datetime.datetime, uuid.UUID] | None = None
+    ) -> list[dict]:
+        """Get up to `limit` log entries, newest first. To get the next page, pass the
+        (log_timestamp, id) of the last entry on the previous page as `after`."""
+        where = ""
+        params: dict = {"limit": limit}
+        if after is not None:
+            where = "where (log_timestamp, id) < (%(after_timestamp)s, %(after_id)s)"
+            params.update({"after_timestamp": after[0], "after_id": after[1]})
+        sql = f"""
             select id, log_timestamp, log_text
             from captains_log
-            order by log_timestamp desc
+            {where}
+            order by log_timestamp desc, id desc
             limit %(limit)s
-        """
-        params = {"limit": limit}
+        """  # noqa: S608
         return self.q(sql, params)
 
     def captains_log_update(self, id_: str, log_text: str) -> None:
@@ -223,6 +436,38 @@ class YavinDatabase(fort.PostgresDatabase):
         params = {"id": uuid.UUID(hex=id_), "log_text": log_text}
         self.u(sql, params)
 
+    # dashboard
+
+    def dashboard_summary(self) -> dict:
+        """Get every value shown on the dashboard cards. The values are kept in the
+        dashboard_summary table by the methods that write the underlying data, so
+        this is a single primary key lookup."""
+        sql = """
+            select
+                balances_accounts_count, billboard_artist, billboard_title,
+                callings_calling, callings_sustained_at, jar_last_entry,
+                library_books_count, library_due_dates, mileage_updated_at,
+                movie_night_next_pick, tithing_owed, weight_entry_date,
+                weight_weight, updated_at
+            from dashboard_summary
+            where id = 1
+        """
+        summary = dict(self.q_one(sql) or {})
+        summary["jar_days_since_last"] = _days_since(summary.get("jar_last_entry"))
+        today = datetime.date.today()
+        summary["library_overdue_count"] = sum(
+            1 for due in summary.get("library_due_dates") or [] if due < today
+        )
+        return summary
+
+    def dashboard_summary_refresh(self, *sections: str) -> None:
+        """Recompute the given sections of the dashboard_summary table, or all of
+        them if no sections are given. Writes that change a section use u_summary to
+        recompute it in their own transaction."""
+        self.u(_dashboard_summary_update(sections or _dashboard_summary_sections))
+        for section in sections or _dashboard_summary_sections:
+            yavin.cache.fragments.invalidate_tag(f"dashboard:{section}")
+
     # electricity
 
     def electricity_insert(
@@ -275,6 +520,96 @@ class YavinDatabase(fort.PostgresDatabase):
         """
         return self.q(sql)
 
+    # email outbox
+
+    def email_outbox_claim(self, limit: int) -> list[dict]:
+        """Lease up to `limit` messages that are due to be sent, oldest first. A
+        leased message is not handed out again for ten minutes, unless it is marked as
+        failed sooner."""
+        sql = """
+            update email_outbox
+            set attempts = attempts + 1,
+                next_attempt_at = current_timestamp + interval '10 minutes'
+            where id in (
+                select id
+                from email_outbox
+                where sent_at is null
+                and next_attempt_at <= current_timestamp
+                order by id
+                limit %(limit)s
+                for update skip locked
+            )
+            returning id, subject, body, to_address, created_at, attempts
+        """
+        params = {"limit": limit}
+        return sorted(self.q(sql, params), key=lambda m: m["id"])
+
+    def email_outbox_failed(
+        self, id_: int, error: str, retry_in: float | None = None
+    ) -> None:
+        """Record a failed delivery. The message is tried again after `retry_in`
+        seconds, or never if `retry_in` is None."""
+        sql = """
+            update email_outbox
+            set last_error = %(error)s,
+                next_attempt_at =
+                    current_timestamp + make_interval(secs => %(retry_in)s)
+            where id = %(id)s
+        """
+        params = {"id": id_, "error": error, "retry_in": retry_in}
+        self.u(sql, params)
+
+    def email_outbox_insert(self, subject: str, body: str, to_address: str) -> int:
+        sql = """
+            insert into email_outbox (subject, body, to_address)
+            values (%(subject)s, %(body)s, %(to_address)s)
+            returning id
+        """
+        params = {"subject": subject, "body": body, "to_address": to_address}
+        id_: int = self.q_val(sql, params)
+        return id_
+
+    def email_outbox_prune(self) -> None:
+        sql = """
+            delete from email_outbox
+            where sent_at < current_timestamp - interval '30 days'
+        """
+        self.u(sql)
+
+    def email_outbox_sent(self, id_: int) -> decimal.Decimal:
+        """Record a delivered message and return the seconds it spent in the outbox"""
+        sql = """
+            update email_outbox
+            set sent_at = current_timestamp,
+                latency_seconds = round(
+                    extract(epoch from current_timestamp - created_at), 3
+                ),
+                last_error = null
+            where id = %(id)s
+            returning latency_seconds
+        """
+        params = {"id": id_}
+        return self.q_val(sql, params)
+
+    def email_outbox_stats(self) -> dict:
+        sql = """
+            select
+                count(*) filter (where sent_at is null and next_attempt_at is not null)
+                    pending,
+                count(*) filter (where sent_at is null and next_attempt_at is null)
+                    abandoned,
+                count(*) filter (where sent_at > current_timestamp - interval '1 day')
+                    sent_last_day,
+                avg(latency_seconds) filter (
+                    where sent_at > current_timestamp - interval '1 day'
+                ) avg_latency_seconds,
+                max(latency_seconds) filter (
+                    where sent_at > current_timestamp - interval '1 day'
+                ) max_latency_seconds
+            from email_outbox
+        """
+        return dict(self.q_one(sql) or {})
+
     # jar
 
     def jar_entries_days_since_last(self) -> int:
@@ -284,38 +619,36 @@ class YavinDatabase(fort.PostgresDatabase):
             select max(entry_date) last_entry
             from jar_entries
         """
-        last_entry = self.q_val(sql)
-        if last_entry is None:
-            return -1
-        if last_entry > datetime.date.today():
-            return 0
-        return (datetime.date.today() - last_entry).days
+        return _days_since(self.q_val(sql))
 
-    def jar_entries_insert(self, entry_date: datetime.date) -> None:
-        sql = """
-            select max(id) max_id
-            from jar_entries
-        """
-        last: int = self.q_val(sql)
-        if last is None:
-            last = 0
+    def jar_entries_insert(self, entry_date: datetime.date) -> int:
         sql = """
-            insert into jar_entries (id, entry_date)
-            values (%(id)s, %(entry_date)s)
+            insert into jar_entries (entry_date)
+            values (%(entry_date)s)
+            returning id
         """
-        params = {"id": last + 1, "entry_date": entry_date}
-        self.u(sql, params)
-
-    def jar_entries_list(self, page: int = 1) -> list[dict]:
-        sql = """
+        params = {"entry_date": entry_date}
+        # insert ... returning always returns the new row
+        row = cast(dict, self.u_summary("jar", sql, params))
+        return row["id"]
+
+    def jar_entries_list(
+        self, limit: int = 10, after: tuple[datetime.date, int] | None = None
+    ) -> list[dict]:
+        """Get up to `limit` jar entries, newest first. To get the next page, pass the
+        (entry_date, id) of the last entry on the previous page as `after`."""
+        where = ""
+        params: dict = {"limit": limit}
+        if after is not None:
+            where = "where (entry_date, id) < (%(after_date)s, %(after_id)s)"
+            params.update({"after_date": after[0], "after_id": after[1]})
+        sql = f"""
             select id, entry_date
             from jar_entries
-            order by entry_date desc, id
-            limit 11 offset %(offset)s
-        """
-        params = {
-            "offset": 10 * (page - 1),
-        }
+            {where}
+            order by entry_date desc, id desc
+            limit %(limit)s
+        """  # noqa: S608
         return self.q(sql, params)
 
     def jar_entries_list_all(self) -> list[dict]:
@@ -332,7 +665,7 @@ class YavinDatabase(fort.PostgresDatabase):
             delete from library_credentials
             where id = %(id)s
         """
-        self.u(sql, params)
+        self.u_summary("library", sql, params)
 
     def library_credentials_insert(self, params: dict) -> None:
         sql = """
@@ -349,13 +682,29 @@ class YavinDatabase(fort.PostgresDatabase):
 
     def library_credentials_list(self) -> list[LibraryCredential]:
         sql = """
-            select id, library, username, password, display_name, balance, library_type
+            select
+                id, library, username, password, display_name, balance, library_type,
+                last_synced_at, last_sync_seconds, last_sync_error
             from library_credentials
             order by display_name
         """
         rows = cast(list[LibraryCredential], cast(object, self.q(sql)))
         return rows
 
+    def library_credentials_set_sync_result(
+        self, id_: uuid.UUID, seconds: float, error: str | None = None
+    ) -> None:
+        """Record how long the last sync for a credential took, and why it failed"""
+        sql = """
+            update library_credentials
+            set last_synced_at = current_timestamp,
+                last_sync_seconds = round(%(seconds)s::numeric, 3),
+                last_sync_error = %(error)s
+            where id = %(id)s
+        """
+        params = {"id": id_, "seconds": seconds, "error": error}
+        self.u(sql, params)
+
     def library_books_count(self) -> dict:
         sql = """
             select
@@ -404,11 +753,113 @@ class YavinDatabase(fort.PostgresDatabase):
         """
         return self.q(sql)
 
-    def library_books_truncate(self) -> None:
+    def library_books_sync(self, credential_id: uuid.UUID, loans: list[dict]) -> dict:
+        """Make the books stored for one library credential match `loans`, in a
+        single statement. New loans are inserted, loans whose details changed are
+        updated, and books that are no longer on loan are deleted. Readers see either
+        the old set of books or the new one, never an empty or partial table.
+
+        Each loan is a dict with item_id, title, due, renewable and medium. Returns
+        the number of books inserted, updated and deleted. The library section of the
+        dashboard summary is recomputed in the same transaction."""
+        # Later duplicates of an item_id replace earlier ones
+        by_item_id = {
+            loan["item_id"]: {**loan, "due": loan["due"].isoformat()} for loan in loans
+        }
+        sql = """
+            with loans as (
+                select *
+                from jsonb_to_recordset(%(loans)s) as l(
+                    item_id text, title text, due date, renewable boolean, medium text
+                )
+            ),
+            deleted as (
+                delete from library_books b
+                where b.credential_id = %(credential_id)s
+                and not exists (select from loans l where l.item_id = b.item_id)
+                returning b.id
+            ),
+            updated as (
+                update library_books b
+                set title = l.title, due = l.due, renewable = l.renewable,
+                    medium = l.medium
+                from loans l
+                where b.credential_id = %(credential_id)s
+                and b.item_id = l.item_id
+                and (b.title, b.due, b.renewable, b.medium)
+                    is distinct from (l.title, l.due, l.renewable, l.medium)
+                returning b.id
+            ),
+            inserted as (
+                insert into library_books (
+                    id, credential_id, title, due, renewable, item_id, medium
+                )
+                select
+                    gen_random_uuid(), %(credential_id)s, l.title, l.due, l.renewable,
+                    l.item_id, l.medium
+                from loans l
+                where not exists (
+                    select from library_books b
+                    where b.credential_id = %(credential_id)s
+                    and b.item_id = l.item_id
+                )
+                returning id
+            )
+            select
+                (select count(*) from inserted) inserted,
+                (select count(*) from updated) updated,
+                (select count(*) from deleted) deleted
+        """
+        params = {
+            "credential_id": credential_id,
+            "loans": psycopg2.extras.Json(list(by_item_id.values())),
+        }
+        return dict(self.u_summary("library", sql, params) or {})
+
+    def library_sessions_delete(self, credential_id: uuid.UUID) -> None:
         sql = """
-            truncate table library_books
+            delete from library_sessions
+            where credential_id = %(credential_id)s
         """
-        self.u(sql)
+        params = {"credential_id": credential_id}
+        self.u(sql, params)
+
+    def library_sessions_get(self, credential_id: uuid.UUID, key: str) -> dict | None:
+        """Get the saved session state for a library credential, decrypted with
+        `key`. Returns None if there is no saved session, or if it can't be decrypted
+        with this key."""
+        sql = """
+            select pgp_sym_decrypt(session, %(key)s)::jsonb
+            from library_sessions
+            where credential_id = %(credential_id)s
+        """
+        params = {"credential_id": credential_id, "key": key}
+        try:
+            return self.q_val(sql, params)
+        except psycopg2.Error:
+            log.warning(f"Could not decrypt the saved session for {credential_id}")
+            return None
+
+    def library_sessions_set(
+        self, credential_id: uuid.UUID, session: dict, key: str
+    ) -> None:
+        """Save the session state for a library credential, encrypted with `key`"""
+        sql = """
+            insert into library_sessions (credential_id, session, updated_at)
+            values (
+                %(credential_id)s,
+                pgp_sym_encrypt(%(session)s, %(key)s),
+                current_timestamp
+            )
+            on conflict (credential_id) do update
+            set session = excluded.session, updated_at = excluded.updated_at
+        """
+        params = {
+            "credential_id": credential_id,
+            "session": json.dumps(session),
+            "key": key,
+        }
+        self.u(sql, params)
 
     # mileage
 
@@ -419,7 +870,7 @@ class YavinDatabase(fort.PostgresDatabase):
             on conflict (entry_date) do nothing
         """
         params = {"entry_date": entry_date, "mileage": mileage}
-        self.u(sql, params)
+        self.u_summary("mileage", sql, params)
 
     def mileage_entries_delete(self, entry_date: datetime.date) -> None:
         sql = """
@@ -427,16 +878,25 @@ class YavinDatabase(fort.PostgresDatabase):
             where entry_date = %(entry_date)s
         """
         params = {"entry_date": entry_date}
-        self.u(sql, params)
-
-    def mileage_entries_list(self, limit: int = 100) -> list[dict]:
-        sql = """
+        self.u_summary("mileage", sql, params)
+
+    def mileage_entries_list(
+        self, limit: int = 100, after: datetime.date | None = None
+    ) -> list[dict]:
+        """Get up to `limit` entries, newest first. To get the next page, pass the
+        entry_date of the last entry on the previous page as `after`."""
+        where = ""
+        params: dict = {"limit": limit}
+        if after is not None:
+            where = "where entry_date < %(after)s"
+            params.update({"after": after})
+        sql = f"""
             select entry_date, mileage
             from mileage_entries
+            {where}
             order by entry_date desc
             limit %(limit)s
-        """
-        params = {"limit": limit}
+        """  # noqa: S608
         return self.q(sql, params)
 
     def mileage_entries_get_for_date(self, entry_date: datetime.date) -> dict | None:
@@ -448,14 +908,67 @@ class YavinDatabase(fort.PostgresDatabase):
         params = {"entry_date": entry_date}
         return self.q_one(sql, params)
 
-    def mileage_entries_list_all(self) -> list[dict]:
+    def mileage_entries_list_for_chart(
+        self, weekly_before: datetime.date
+    ) -> list[dict]:
+        """Get every entry on or after `weekly_before`, and only the last entry of
+        each week before it, oldest first. This keeps the number of points on the
+        chart bounded however long the history gets."""
         sql = """
+            select entry_date, mileage
+            from (
+                select distinct on (date_trunc('week', entry_date))
+                    entry_date, mileage
+                from mileage_entries
+                where entry_date < %(weekly_before)s
+                order by date_trunc('week', entry_date), entry_date desc
+            ) weekly
+            union all
             select entry_date, mileage
             from mileage_entries
+            where entry_date >= %(weekly_before)s
             order by entry_date
         """
+        params = {"weekly_before": weekly_before}
+        return self.q(sql, params)
+
+    # mirror
+
+    def mirror_changes_delete(self, ids: list[int]) -> None:
+        sql = """
+            delete from mirror_changes
+            where id = any(%(ids)s)
+        """
+        params = {"ids": ids}
+        self.u(sql, params)
+
+    def mirror_changes_ids(self) -> list[int]:
+        sql = """
+            select id
+            from mirror_changes
+        """
+        return [r["id"] for r in self.q(sql)]
+
+    def mirror_changes_list(self) -> list[dict]:
+        """Get the row changes logged since the SQLite mirror last consumed them. For
+        inserts and updates, new_row is the row after the change. For updates and
+        deletes, old_row is the row before it. A truncate logs neither."""
+        sql = """
+            select id, table_name, op, old_row, new_row
+            from mirror_changes
+            order by id
+        """
         return self.q(sql)
 
+    def mirror_changes_prune(self) -> int:
+        """Delete changes logged more than a week ago and return how many were
+        deleted. mirror_sync applies them long before then when it is scheduled."""
+        sql = """
+            delete from mirror_changes
+            where changed_at < current_timestamp - interval '7 days'
+        """
+        return self.u(sql)
+
     # movie night
 
     def movie_people_insert(self, params: dict) -> None:
@@ -464,7 +977,7 @@ class YavinDatabase(fort.PostgresDatabase):
             values (%(id)s, %(person)s)
         """
         params.update({"id": uuid.uuid4()})
-        self.u(sql, params)
+        self.u_summary("movie_night", sql, params)
 
     def movie_people_list(self) -> list[dict]:
         sql = """
@@ -502,7 +1015,7 @@ class YavinDatabase(fort.PostgresDatabase):
             delete from movie_picks
             where id = %(id)s
         """
-        self.u(sql, params)
+        self.u_summary("movie_night", sql, params)
 
     def movie_picks_get(self, pick_id: uuid.UUID) -> dict | None:
         sql = """
@@ -521,7 +1034,7 @@ class YavinDatabase(fort.PostgresDatabase):
         params.update({"id": uuid.uuid4()})
         if params.get("pick_url") == "":
             params.update({"pick_url": None})
-        self.u(sql, params)
+        self.u_summary("movie_night", sql, params)
 
     def movie_picks_list(self) -> list[dict]:
         sql = """
@@ -541,7 +1054,7 @@ class YavinDatabase(fort.PostgresDatabase):
         """
         if params.get("pick_url") == "":
             params.update({"pick_url": None})
-        self.u(sql, params)
+        self.u_summary("movie_night", sql, params)
 
     # phone usage
 
@@ -588,15 +1101,21 @@ class YavinDatabase(fort.PostgresDatabase):
         """
         params = {"setting_id": setting_id}
         self.u(sql, params)
+        _settings_cache.clear()
 
     def settings_list(self) -> dict[str, str]:
-        sql = """
-            select setting_id, setting_value
-            from settings
-        """
-        return {
-            s.get("setting_id", ""): s.get("setting_value", "") for s in self.q(sql)
-        }
+        generation = _settings_cache.generation("settings")
+        cached = _settings_cache.get("settings")
+        if cached is None:
+            sql = """
+                select setting_id, setting_value
+                from settings
+            """
+            cached = {
+                s.get("setting_id", ""): s.get("setting_value", "") for s in self.q(sql)
+            }
+            _settings_cache.set("settings", cached, generation)
+        return dict(cached)
 
     def settings_update(self, setting_id: str, setting_value: str) -> None:
         sql = """
@@ -606,6 +1125,105 @@ class YavinDatabase(fort.PostgresDatabase):
         """
         params = {"setting_id": setting_id, "setting_value": setting_value}
         self.u(sql, params)
+        _settings_cache.clear()
+
+    # task requests
+
+    def task_requests_claim(self) -> dict | None:
+        """Mark the oldest pending task request as started and return it. A request is
+        not claimed while an earlier run of the same task is still going."""
+        sql = """
+            update task_requests
+            set started_at = current_timestamp
+            where id = (
+                select id
+                from task_requests t
+                where started_at is null
+                and not exists (
+                    select
+                    from task_requests r
+                    where r.task = t.task
+                    and r.started_at is not null
+                    and r.finished_at is null
+                )
+                order by id
+                limit 1
+                for update skip locked
+            )
+            returning id, task
+        """
+        return self.q_one(sql)
+
+    def task_requests_finish(
+        self, id_: int, seconds: float, error: str | None = None
+    ) -> None:
+        sql = """
+            update task_requests
+            set finished_at = current_timestamp,
+                seconds = round(%(seconds)s::numeric, 3),
+                error = %(error)s
+            where id = %(id)s
+        """
+        params = {"id": id_, "seconds": seconds, "error": error}
+        self.u(sql, params)
+
+    def task_requests_insert(self, task: str) -> None:
+        """Ask the worker to run `task`. If a run is already waiting to start, this
+        request is merged into it."""
+        sql = """
+            insert into task_requests (task)
+            values (%(task)s)
+            on conflict (task) where started_at is null do nothing
+        """
+        params = {"task": task}
+        self.u(sql, params)
+
+    def task_requests_interrupt(self) -> None:
+        """Mark runs that were started but never finished as failed. Only the worker
+        that holds the leader lock runs tasks, so these belonged to a worker that
+        stopped."""
+        sql = """
+            update task_requests
+            set finished_at = current_timestamp, error = 'interrupted'
+            where started_at is not null
+            and finished_at is null
+        """
+        self.u(sql)
+
+    def task_requests_prune(self) -> None:
+        sql = """
+            delete from task_requests
+            where finished_at < current_timestamp - interval '30 days'
+        """
+        self.u(sql)
+
+    def task_requests_status(self, task: str) -> dict:
+        """Get whether `task` is running or waiting to start, and how its last run
+        went"""
+        sql = """
+            select
+                coalesce(
+                    bool_or(t.started_at is not null and t.finished_at is null), false
+                ) running,
+                coalesce(bool_or(t.id is not null and t.started_at is null), false)
+                    queued,
+                last.finished_at last_finished_at,
+                last.seconds last_seconds,
+                last.error last_error
+            from (select %(task)s task) k
+            left join task_requests t on t.task = k.task
+            left join lateral (
+                select finished_at, seconds, error
+                from task_requests
+                where task = k.task
+                and finished_at is not null
+                order by finished_at desc
+                limit 1
+            ) last on true
+            group by last.finished_at, last.seconds, last.error
+        """
+        params = {"task": task}
+        return dict(self.q_one(sql, params) or {})
 
     # tithing
 
@@ -629,7 +1247,7 @@ class YavinDatabase(fort.PostgresDatabase):
             "amount": amount,
             "description": description,
         }
-        self.u(sql, params)
+        self.u_summary("tithing", sql, params)
 
     def tithing_income_list_all(self) -> list[dict]:
         sql = """
@@ -653,12 +1271,13 @@ class YavinDatabase(fort.PostgresDatabase):
             set tithing_paid = current_date
             where tithing_paid is null
         """
-        self.u(sql)
+        self.u_summary("tithing", sql)
 
     # user permissions
 
     def user_permissions_add(self, email: str, permission: str) -> None:
-        existing_permissions = self.user_permissions_get(email)
+        # Read through to the database so a stale cache entry can't drop permissions
+        existing_permissions = self._user_permissions_query(email)
         if permission in existing_permissions:
             self.log.debug(f"{email} already has permission {permission}")
             return
@@ -666,6 +1285,14 @@ class YavinDatabase(fort.PostgresDatabase):
         self.user_permissions_set(email, new_permissions)
 
     def user_permissions_get(self, email: str) -> list[str]:
+        generation = _user_permissions_cache.generation(email)
+        cached = _user_permissions_cache.get(email)
+        if cached is None:
+            cached = self._user_permissions_query(email)
+            _user_permissions_cache.set(email, cached, generation)
+        return list(cached)
+
+    def _user_permissions_query(self, email: str) -> list[str]:
         sql = """
             select permissions from user_permissions where email = %(email)s
         """
@@ -697,6 +1324,7 @@ class YavinDatabase(fort.PostgresDatabase):
         """
         params = {"email": email, "permissions": " ".join(sorted(set(permissions)))}
         self.u(sql, params)
+        _user_permissions_cache.invalidate(email)
 
     # weight
 
@@ -729,21 +1357,44 @@ class YavinDatabase(fort.PostgresDatabase):
             on conflict (entry_date) do nothing
         """
         params = {"entry_date": entry_date, "weight": weight}
-        self.u(sql, params)
-
-    def weight_entries_list(self, limit: int = 10) -> list[dict]:
-        sql = """
+        self.u_summary("weight", sql, params)
+
+    def weight_entries_list(
+        self, limit: int = 10, after: datetime.date | None = None
+    ) -> list[dict]:
+        """Get up to `limit` entries, newest first. To get the next page, pass the
+        entry_date of the last entry on the previous page as `after`."""
+        where = ""
+        params: dict = {"limit": limit}
+        if after is not None:
+            where = "where entry_date < %(after)s"
+            params.update({"after": after})
+        sql = f"""
             select entry_date, weight
             from weight_entries
+            {where}
             order by entry_date desc
             limit %(limit)s
-        """
-        params = {"limit": limit}
+        """  # noqa: S608
         return self.q(sql, params)
 
     # migrations and metadata
 
     def migrate(self) -> None:
+        """Bring the schema up to date. Only one process migrates at a time, and a
+        process that waited for another one sees the version it left behind."""
+        lock_cnx = psycopg2.connect(self.p.dsn, **self.p.kwargs)
+        try:
+            lock_cnx.autocommit = True
+            with lock_cnx.cursor() as c:
+                c.execute("select pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            self._version = -1
+            self._migrate()
+        finally:
+            # Closing the connection releases the lock
+            lock_cnx.close()
+
+    def _migrate(self) -> None:
         self.log.debug(f"The database is at schema version {self.version}")
         self.log.debug("Checking for database migrations ...")
         if self.version < 23:
@@ -920,6 +1571,208 @@ class YavinDatabase(fort.PostgresDatabase):
                 )
             """)
             self._add_schema_version(24)
+        if self.version < 25:
+            self.log.debug("Migrating to version 25")
+            self.u("""
+                create table dashboard_summary (
+                    id integer primary key default 1 check (id = 1),
+                    balances_accounts_count integer not null default 0,
+                    billboard_artist text,
+                    billboard_title text,
+                    callings_calling text,
+                    callings_sustained_at date,
+                    jar_last_entry date,
+                    library_books_count integer not null default 0,
+                    library_due_dates date[] not null default '{}',
+                    movie_night_next_pick text,
+                    tithing_owed numeric not null default 0,
+                    weight_entry_date date,
+                    weight_weight numeric,
+                    updated_at timestamptz
+                )
+            """)
+            self.u("""
+                insert into dashboard_summary (id) values (1)
+            """)
+            self._add_schema_version(25)
+        if self.version < 26:
+            self.log.debug("Migrating to version 26")
+            self.u("""
+                create index captains_log_log_timestamp_id_idx
+                on captains_log (log_timestamp, id)
+            """)
+            self.u("""
+                create index jar_entries_entry_date_id_idx
+                on jar_entries (entry_date, id)
+            """)
+            self._add_schema_version(26)
+        if self.version < 27:
+            self.log.debug("Migrating to version 27")
+            self.u("""
+                alter table jar_entries
+                alter column id add generated by default as identity
+            """)
+            self.u("""
+                select setval(
+                    pg_get_serial_sequence('jar_entries', 'id'),
+                    coalesce(max(id), 0) + 1,
+                    false
+                )
+                from jar_entries
+            """)
+            self._add_schema_version(27)
+        if self.version < 28:
+            self.log.debug("Migrating to version 28")
+            self.u("""
+                create table mirror_changes (
+                    id bigint primary key generated always as identity,
+                    table_name text not null,
+                    op text not null,
+                    old_row jsonb,
+                    new_row jsonb,
+                    changed_at timestamptz not null default current_timestamp
+                )
+            """)
+            self.u("""
+                create function mirror_log_change() returns trigger
+                language plpgsql as $$
+                begin
+                    if tg_op = 'TRUNCATE' then
+                        insert into mirror_changes (table_name, op)
+                        values (tg_table_name, 'truncate');
+                    elsif tg_op = 'INSERT' then
+                        insert into mirror_changes (table_name, op, new_row)
+                        values (tg_table_name, 'insert', to_jsonb(new));
+                    elsif tg_op = 'UPDATE' then
+                        insert into mirror_changes (table_name, op, old_row, new_row)
+                        values (tg_table_name, 'update', to_jsonb(old), to_jsonb(new));
+                    else
+                        insert into mirror_changes (table_name, op, old_row)
+                        values (tg_table_name, 'delete', to_jsonb(old));
+                    end if;
+                    return null;
+                end
+                $$
+            """)
+            mirrored_tables = [
+                "balances_accounts",
+                "balances_transactions",
+                "billboard_number_one",
+                "callings",
+                "captains_log",
+                "electricity",
+                "hymn_history",
+                "hymn_tags",
+                "hymns",
+                "jar_entries",
+                "library_books",
+                "library_credentials",
+                "mileage_entries",
+                "movie_people",
+                "movie_picks",
+                "phone_usage",
+                "settings",
+                "tithing_income",
+                "user_permissions",
+                "weight_entries",
+            ]
+            for table in mirrored_tables:
+                self.u(f"""
+                    create trigger {table}_mirror
+                    after insert or update or delete on {table}
+                    for each row execute function mirror_log_change()
+                """)
+                self.u(f"""
+                    create trigger {table}_mirror_truncate
+                    after truncate on {table}
+                    for each statement execute function mirror_log_change()
+                """)
+            self._add_schema_version(28)
+        if self.version < 29:
+            self.log.debug("Migrating to version 29")
+            self.u("""
+                alter table library_credentials
+                add column last_synced_at timestamptz,
+                add column last_sync_seconds numeric,
+                add column last_sync_error text
+            """)
+            self._add_schema_version(29)
+        if self.version < 30:
+            self.log.debug("Migrating to version 30")
+            self.u("""
+                create table library_sessions (
+                    credential_id uuid primary key
+                        references library_credentials (id)
+                        on delete cascade,
+                    session bytea not null,
+                    updated_at timestamptz not null
+                )
+            """)
+            self._add_schema_version(30)
+        if self.version < 31:
+            self.log.debug("Migrating to version 31")
+            self.u("""
+                create table task_requests (
+                    id bigint primary key generated always as identity,
+                    task text not null,
+                    requested_at timestamptz not null default current_timestamp,
+                    started_at timestamptz,
+                    finished_at timestamptz,
+                    seconds numeric,
+                    error text
+                )
+            """)
+            self.u("""
+                create unique index task_requests_pending_idx
+                on task_requests (task)
+                where started_at is null
+            """)
+            self._add_schema_version(31)
+
+        if self.version < 32:
+            self.log.debug("Migrating to version 32")
+            self.u("""
+                create table email_outbox (
+                    id bigint primary key generated always as identity,
+                    subject text not null,
+                    body text not null,
+                    to_address text not null,
+                    created_at timestamptz not null default current_timestamp,
+                    attempts integer not null default 0,
+                    next_attempt_at timestamptz default current_timestamp,
+                    last_error text,
+                    sent_at timestamptz,
+                    latency_seconds numeric
+                )
+            """)
+            self.u("""
+                create index email_outbox_due_idx
+                on email_outbox (next_attempt_at)
+                where sent_at is null
+            """)
+            self._add_schema_version(32)
+
+        if self.version < 33:
+            self.log.debug("Migrating to version 33")
+            self.u("""
+                alter table billboard_number_one
+                add column etag text,
+                add column last_modified text
+            """)
+            self._add_schema_version(33)
+
+        if self.version < 34:
+            self.log.debug("Migrating to version 34")
+            self.u("""
+                alter table dashboard_summary
+                add column mileage_updated_at timestamptz
+            """)
+            self.u("""
+                update dashboard_summary
+                set mileage_updated_at = current_timestamp
+                where id = 1
+            """)
+            self._add_schema_version(34)
 
     def _add_schema_version(self, schema_version: int) -> None:
         self._version = schema_version
@@ -1,26 +1,206 @@
+import contextlib
 import datetime
+import decimal
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+from collections.abc import Iterator
+from typing import ClassVar
 
 import fort
 
+# Bytes of the GnuCash file to memory-map, and KiB of page cache per connection
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+
+# Splits posted between :start_date and :end_date (inclusive) to :account or any of
+# its subaccounts. Transactions are found with the post_date index, then filtered by
+# account. The unary + stops SQLite from driving the query from
+# splits_account_guid_index instead, which reads every split in the matching
+# accounts no matter how short the date range is.
+_SPLITS_IN_RANGE = """
+    from transactions t
+    join splits s on s.tx_guid = t.guid
+    join yavin.account_paths a on a.guid = s.account_guid
+    where t.post_date >= :start_date
+    and t.post_date < date(:end_date, '+1 day')
+    and +s.account_guid in (
+        select guid
+        from yavin.account_paths
+        where full_name = :account
+        or (
+            :subaccounts
+            and substr(full_name, 1, length(:account) + 1) = :account || ':'
+        )
+    )
+"""
+
+# Expressions that expense totals can be grouped by
+_TOTAL_GROUPS = {
+    "account": "a.full_name",
+    "day": "substr(t.post_date, 1, 10)",
+    "month": "substr(t.post_date, 1, 7)",
+}
+
+
+def _file_version(path: str) -> tuple[int, int, int, int]:
+    """Changes whenever GnuCash saves the file, whether it rewrites it in place or
+    replaces it with a new file"""
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size
+
 
 class ExpensesDatabase(fort.SQLiteDatabase):
+    """A read-only connection to a GnuCash SQLite file. Use shared() to get a
+    connection that is kept open between requests."""
+
+    # Each thread keeps its own connections, keyed by path
+    _local: ClassVar[threading.local] = threading.local()
+
+    def __init__(self, path: str) -> None:
+        # fort.SQLiteDatabase.__init__ would open the file read-write
+        self.log = logging.getLogger(fort.SQLiteDatabase.__module__)
+        self.version = _file_version(path)
+        # Queries and cursors still reading from this connection
+        self._users = 0
+        self._replaced = False
+        uri = f"{pathlib.Path(path).absolute().as_uri()}?mode=ro"
+        self.cnx = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.cnx.isolation_level = None
+        self.cnx.row_factory = sqlite3.Row
+        self.cnx.set_trace_callback(self.log.debug)
+        self.cnx.execute(f"pragma mmap_size = {MMAP_SIZE}")
+        self.cnx.execute(f"pragma cache_size = -{CACHE_SIZE_KIB}")
+        self._index_accounts()
+
+    def _index_accounts(self) -> None:
+        """v_account_full_names walks the whole account tree every time it is used.
+        Flatten it once per file version into an in-memory database attached to this
+        connection, since the GnuCash file itself is opened read-only."""
+        self.u("attach database ':memory:' as yavin")
+        self.u("""
+            create table yavin.account_paths (
+                guid text primary key,
+                full_name text not null
+            )
+        """)
+        self.u("""
+            insert into yavin.account_paths (guid, full_name)
+            select guid, full_name
+            from v_account_full_names
+        """)
+        self.u("""
+            create index yavin.account_paths_full_name_idx
+            on account_paths (full_name)
+        """)
+
+    @classmethod
+    def shared(cls, path: str) -> ExpensesDatabase:
+        """Return the current thread's connection to `path`, which is kept open
+        between the requests that thread handles. It is replaced with a new
+        connection when the file changes on disk, so the schema is only read again
+        after GnuCash saves."""
+        version = _file_version(path)
+        shared: dict[str, ExpensesDatabase] = cls._local.__dict__.setdefault(
+            "shared", {}
+        )
+        db = shared.get(path)
+        if db is None or db.version != version:
+            if db is not None:
+                db._replace()
+            db = cls(path)
+            shared[path] = db
+        return db
+
+    def _replace(self) -> None:
+        self._replaced = True
+        if self._users == 0:
+            self.cnx.close()
+
+    @contextlib.contextmanager
+    def _use(self) -> Iterator[None]:
+        """Keep the connection open until the block finishes, even if it is
+        replaced in the meantime"""
+        self._users += 1
+        try:
+            yield
+        finally:
+            self._users -= 1
+            if self._replaced and self._users == 0:
+                self.cnx.close()
+
+    def get_expense_totals(
+        self,
+        account: str,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        group_by: str,
+    ) -> dict[str, decimal.Decimal]:
+        """Total the splits under `account` in the date range by "account", "month",
+        or "day". Amounts are summed as integers for each denominator in SQL and
+        combined exactly, so cents never drift."""
+        sql = f"""
+            select
+                {_TOTAL_GROUPS[group_by]} grp, s.value_denom,
+                sum(s.value_num) value_num
+            {_SPLITS_IN_RANGE}
+            group by grp, s.value_denom
+        """
+        params = {
+            "account": account,
+            "end_date": end_date,
+            "start_date": start_date,
+            "subaccounts": 1,
+        }
+        totals: dict[str, decimal.Decimal] = {}
+        for r in self.q(sql, params):
+            amount = decimal.Decimal(r["value_num"]) / r["value_denom"]
+            totals[r["grp"]] = totals.get(r["grp"], 0) + amount
+        return dict(sorted(totals.items()))
+
     def get_expenses(
-        self, account_prefix: str, start_date: datetime.date, end_date: datetime.date
+        self,
+        account: str,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        subaccounts: bool = True,
     ) -> list[dict]:
-        sql = """
+        return [
+            e
+            for chunk in self.iter_expenses(account, start_date, end_date, subaccounts)
+            for e in chunk
+        ]
+
+    def iter_expenses(
+        self,
+        account: str,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        subaccounts: bool = True,
+        chunk_size: int = 1000,
+    ) -> Iterator[list[dict]]:
+        """Yield the splits under `account` in the date range in chunks of up to
+        `chunk_size`, oldest first"""
+        sql = f"""
             select
-                a.full_name account, t.post_date, t.description, s.memo,
-                (s.value_num / cast(s.value_denom as real)) amount
-            from splits s
-            left join v_account_full_names a on a.guid = s.account_guid
-            left join transactions t on t.guid = s.tx_guid
-            where t.post_date between :start_date and :end_date
-            and a.full_name like :account_prefix
+                a.full_name account, t.post_date, t.description, s.memo, s.value_num,
+                s.value_denom
+            {_SPLITS_IN_RANGE}
             order by t.post_date
         """
         params = {
-            "account_prefix": account_prefix,
-            "start_date": start_date,
+            "account": account,
             "end_date": end_date,
+            "start_date": start_date,
+            # app_sqlite registers an adapter that binds bools as text
+            "subaccounts": int(subaccounts),
         }
-        return self.q(sql, params)
+        # The caller may still be reading when the file changes on disk
+        with self._use(), contextlib.closing(self.cnx.execute(sql, params)) as c:
+            while chunk := c.fetchmany(chunk_size):
+                yield [
+                    {**r, "amount": decimal.Decimal(r["value_num"]) / r["value_denom"]}
+                    for r in map(dict, chunk)
+                ]
@@ -0,0 +1,269 @@
+import argparse
+import collections
+import dataclasses
+import logging
+import sqlite3
+import time
+
+import notch
+
+import yavin.db
+import yavin.db.app_sqlite
+import yavin.settings
+
+log = logging.getLogger(__name__)
+
+# table -> columns copied from Postgres into the SQLite mirror
+TABLES: dict[str, tuple[str, ...]] = {
+    "balances_accounts": ("account_name", "id"),
+    "balances_transactions": (
+        "account_id",
+        "tx_date",
+        "tx_description",
+        "tx_id",
+        "tx_value",
+    ),
+    "billboard_number_one": ("artist", "fetched_at", "id", "title"),
+    "callings": (
+        "calling",
+        "id",
+        "released_at",
+        "set_apart_at",
+        "sustained_at",
+        "ward",
+    ),
+    "captains_log": ("id", "log_text", "log_timestamp"),
+    "electricity": ("bill", "bill_date", "charge", "kwh"),
+    "hymn_history": ("date", "hymn_number"),
+    "hymn_tags": ("hymn_number", "tag"),
+    "hymns": ("first_line", "hymn_number", "title"),
+    "jar_entries": ("entry_date", "id", "paid"),
+    "library_books": (
+        "credential_id",
+        "due",
+        "id",
+        "item_id",
+        "medium",
+        "renewable",
+        "title",
+    ),
+    "library_credentials": (
+        "balance",
+        "display_name",
+        "id",
+        "library",
+        "library_type",
+        "password",
+        "username",
+    ),
+    "mileage_entries": ("entry_date", "mileage"),
+    "movie_people": ("id", "person"),
+    "movie_picks": ("id", "person_id", "pick_date", "pick_text", "pick_url"),
+    "phone_usage": (
+        "end_date",
+        "id",
+        "megabytes",
+        "messages",
+        "minutes",
+        "start_date",
+    ),
+    "settings": ("setting_id", "setting_value"),
+    "tithing_income": ("amount", "date", "description", "id", "tithing_paid"),
+    "user_permissions": ("email", "permissions"),
+    "weight_entries": ("entry_date", "weight"),
+}
+
+# table -> primary key columns in Postgres, used to apply logged changes. Changes to
+# tables that are not listed here are applied by copying the whole table again.
+PRIMARY_KEYS: dict[str, tuple[str, ...]] = {
+    "balances_accounts": ("id",),
+    "balances_transactions": ("tx_id",),
+    "billboard_number_one": ("id",),
+    "callings": ("id",),
+    "captains_log": ("id",),
+    "electricity": ("bill_date",),
+    "hymn_tags": ("hymn_number", "tag"),
+    "hymns": ("hymn_number",),
+    "jar_entries": ("id",),
+    "library_books": ("id",),
+    "library_credentials": ("id",),
+    "mileage_entries": ("entry_date",),
+    "movie_people": ("id",),
+    "movie_picks": ("id",),
+    "phone_usage": ("id",),
+    "settings": ("setting_id",),
+    "tithing_income": ("id",),
+    "user_permissions": ("email",),
+    "weight_entries": ("entry_date",),
+}
+
+
+@dataclasses.dataclass
+class TableExport:
+    table: str
+    rows: int
+    seconds: float
+
+
+def _tune_for_bulk_load(con: sqlite3.Connection) -> None:
+    # The mirror can always be rebuilt from Postgres, so durability during the load
+    # does not matter. Each table is still committed in a single transaction.
+    # The safety level can't be changed inside a transaction, so step out of the one
+    # that connection_get() keeps open.
+    con.commit()
+    con.autocommit = True
+    con.execute("pragma synchronous = off")
+    con.execute("pragma cache_size = -65536")
+    con.execute("pragma temp_store = memory")
+    con.autocommit = False
+
+
+def export_table(
+    db: yavin.db.YavinDatabase,
+    con: sqlite3.Connection,
+    table: str,
+    chunk_size: int = 1000,
+) -> TableExport:
+    """Replace the contents of one SQLite table with the rows from Postgres, in a
+    single SQLite transaction"""
+    start = time.monotonic()
+    columns = TABLES[table]
+    cols = ", ".join(columns)
+    placeholders = ", ".join("?" for _ in columns)
+    select_sql = f"select {cols} from {table}"  # noqa: S608
+    insert_sql = f"insert into {table} ({cols}) values ({placeholders})"  # noqa: S608
+    rows = 0
+    try:
+        con.execute(f"delete from {table}")  # noqa: S608
+        for chunk in db.q_iter(select_sql, chunk_size=chunk_size):
+            con.executemany(insert_sql, chunk)
+            rows += len(chunk)
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    return TableExport(table, rows, round(time.monotonic() - start, 3))
+
+
+def sync_table(
+    db: yavin.db.YavinDatabase,
+    con: sqlite3.Connection,
+    table: str,
+    keys: set[tuple],
+) -> TableExport:
+    """Replace the rows with the given primary keys in one SQLite table with their
+    current state in Postgres. Keys that no longer exist in Postgres are deleted."""
+    start = time.monotonic()
+    columns = TABLES[table]
+    primary_key = PRIMARY_KEYS[table]
+    cols = ", ".join(columns)
+    placeholders = ", ".join("?" for _ in columns)
+    select_sql = f"""
+        select {cols} from {table}
+        where ({", ".join(primary_key)}) in %(keys)s
+    """  # noqa: S608
+    where = " and ".join(f"{c} = ?" for c in primary_key)
+    delete_sql = f"delete from {table} where {where}"  # noqa: S608
+    insert_sql = f"insert into {table} ({cols}) values ({placeholders})"  # noqa: S608
+    rows = db.q(select_sql, {"keys": tuple(keys)})
+    try:
+        con.executemany(delete_sql, keys)
+        con.executemany(insert_sql, rows)
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    return TableExport(table, len(rows), round(time.monotonic() - start, 3))
+
+
+def _log_results(results: list[TableExport]) -> None:
+    for result in results:
+        log.info(f"Copied {result.rows} rows to {result.table} in {result.seconds}s")
+    total_rows = sum(r.rows for r in results)
+    total_seconds = round(sum(r.seconds for r in results), 3)
+    log.info(f"Copied {total_rows} rows in {total_seconds}s")
+
+
+def export(
+    db: yavin.db.YavinDatabase, con: sqlite3.Connection, chunk_size: int = 1000
+) -> list[TableExport]:
+    """Copy every table from Postgres into the SQLite mirror"""
+    yavin.db.app_sqlite.migrate(con)
+    # Changes logged before the export starts are covered by it. Changes logged
+    # while it runs are left for the next sync, which applies them again harmlessly.
+    change_ids = db.mirror_changes_ids()
+    _tune_for_bulk_load(con)
+    results = [export_table(db, con, table, chunk_size) for table in TABLES]
+    _log_results(results)
+    yavin.db.app_sqlite.mirror_state_set(con, max(change_ids, default=None))
+    if change_ids:
+        db.mirror_changes_delete(change_ids)
+    return results
+
+
+def sync(
+    db: yavin.db.YavinDatabase, con: sqlite3.Connection, chunk_size: int = 1000
+) -> list[TableExport]:
+    """Apply the changes logged in Postgres since the last export or sync, so the
+    work is proportional to what changed. If the mirror has never been exported, do
+    a full export instead."""
+    yavin.db.app_sqlite.migrate(con)
+    if yavin.db.app_sqlite.mirror_state_get(con) is None:
+        log.info("The SQLite mirror has not been exported yet")
+        return export(db, con, chunk_size)
+
+    changes = db.mirror_changes_list()
+    full_tables: set[str] = set()
+    keys: dict[str, set[tuple]] = collections.defaultdict(set)
+    for change in changes:
+        table = change["table_name"]
+        primary_key = PRIMARY_KEYS.get(table)
+        if change["op"] == "truncate" or primary_key is None:
+            full_tables.add(table)
+            continue
+        for row in (change["old_row"], change["new_row"]):
+            if row is not None:
+                keys[table].add(tuple(row[c] for c in primary_key))
+
+    _tune_for_bulk_load(con)
+    results = []
+    for table in TABLES:
+        if table in full_tables:
+            results.append(export_table(db, con, table, chunk_size))
+        elif table in keys:
+            results.append(sync_table(db, con, table, keys[table]))
+    _log_results(results)
+    change_ids = [c["id"] for c in changes]
+    yavin.db.app_sqlite.mirror_state_set(con, max(change_ids, default=None))
+    if change_ids:
+        db.mirror_changes_delete(change_ids)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Copy the Postgres database into the SQLite mirror"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="copy every table instead of only the rows that changed",
+    )
+    args = parser.parse_args()
+
+    notch.configure()
+    settings = yavin.settings.Settings()
+    db = yavin.db.YavinDatabase(settings.dsn)
+    con = yavin.db.app_sqlite.connection_get(settings.database)
+    try:
+        if args.full:
+            export(db, con)
+        else:
+            sync(db, con)
+    finally:
+        con.close()
+        db.p.closeall()
+
+
+if __name__ == "__main__":
+    main()
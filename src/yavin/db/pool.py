@@ -0,0 +1,197 @@
+import dataclasses
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class PoolStats:
+    maxconn: int
+    size: int
+    in_use: int
+    idle: int
+    checkouts: int
+    waits: int
+    wait_seconds: float
+    max_wait_seconds: float
+    recycled: int
+    discarded: int
+
+
+class ConnectionPool:
+    """A thread-safe pool of Postgres connections, shared by every request in the
+    process. It can stand in for psycopg2.pool.ThreadedConnectionPool in
+    fort.PostgresDatabase.
+
+    When every connection is checked out, getconn() waits up to `timeout` seconds
+    for one to be returned instead of failing. Connections that have been idle for
+    more than `validate_after` seconds are pinged before they are handed out, and
+    connections older than `max_age` seconds are closed and replaced."""
+
+    def __init__(
+        self,
+        minconn: int,
+        maxconn: int,
+        dsn: str,
+        max_age: float = 1800.0,
+        timeout: float = 30.0,
+        validate_after: float = 30.0,
+        **kwargs,  # noqa: ANN003
+    ) -> None:
+        self.minconn = minconn
+        self.maxconn = max(minconn, maxconn)
+        self.dsn = dsn
+        self.kwargs = kwargs
+        self.max_age = max_age
+        self.timeout = timeout
+        self.validate_after = validate_after
+
+        self._cond = threading.Condition()
+        self._closed = False
+        # connection -> monotonic time it was opened
+        self._opened_at: dict[psycopg2.extensions.connection, float] = {}
+        # (connection, monotonic time it was returned), most recently returned last
+        self._idle: list[tuple[psycopg2.extensions.connection, float]] = []
+        # connections being opened right now count against maxconn
+        self._opening = 0
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._recycled = 0
+        self._discarded = 0
+
+        for _ in range(minconn):
+            cnx = psycopg2.connect(self.dsn, **self.kwargs)
+            self._opened_at[cnx] = time.monotonic()
+            self._idle.append((cnx, time.monotonic()))
+
+    def _expired(self, cnx: psycopg2.extensions.connection) -> bool:
+        return time.monotonic() - self._opened_at.get(cnx, 0.0) > self.max_age
+
+    def _is_usable(
+        self, cnx: psycopg2.extensions.connection, returned_at: float
+    ) -> bool:
+        if cnx.closed:
+            return False
+        status = cnx.info.transaction_status
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                cnx.rollback()
+            if time.monotonic() - returned_at < self.validate_after:
+                return True
+            with cnx.cursor() as c:
+                c.execute("select 1")
+            cnx.rollback()
+        except psycopg2.Error:
+            log.warning("Discarding a pooled connection that failed validation")
+            return False
+        return True
+
+    def _discard(self, cnx: psycopg2.extensions.connection) -> None:
+        self._opened_at.pop(cnx, None)
+        if not cnx.closed:
+            try:
+                cnx.close()
+            except psycopg2.Error:
+                log.exception("Error closing a pooled connection")
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        start = time.monotonic()
+        waited = False
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise psycopg2.pool.PoolError("connection pool is closed")
+                    if self._idle:
+                        cnx, returned_at = self._idle.pop()
+                        break
+                    if len(self._opened_at) + self._opening < self.maxconn:
+                        cnx, returned_at = None, 0.0
+                        self._opening += 1
+                        break
+                    remaining = self.timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        raise psycopg2.pool.PoolError(
+                            f"timed out after {self.timeout}s waiting for a connection"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if cnx is None:
+                try:
+                    cnx = psycopg2.connect(self.dsn, **self.kwargs)
+                except BaseException:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._opening -= 1
+                    self._opened_at[cnx] = time.monotonic()
+            elif self._expired(cnx):
+                log.debug("Recycling a pooled connection that reached its max age")
+                with self._cond:
+                    self._recycled += 1
+                    self._discard(cnx)
+                continue
+            elif not self._is_usable(cnx, returned_at):
+                with self._cond:
+                    self._discarded += 1
+                    self._discard(cnx)
+                continue
+
+            wait_seconds = time.monotonic() - start
+            with self._cond:
+                self._checkouts += 1
+                if waited:
+                    self._waits += 1
+                    self._wait_seconds += wait_seconds
+                    self._max_wait_seconds = max(self._max_wait_seconds, wait_seconds)
+            return cnx
+
+    def putconn(self, cnx: psycopg2.extensions.connection, close: bool = False) -> None:
+        with self._cond:
+            if self._closed or close or cnx.closed:
+                self._discard(cnx)
+            elif self._expired(cnx):
+                self._recycled += 1
+                self._discard(cnx)
+            else:
+                self._idle.append((cnx, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self) -> None:
+        with self._cond:
+            self._closed = True
+            for cnx in list(self._opened_at):
+                self._discard(cnx)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def stats(self) -> PoolStats:
+        with self._cond:
+            size = len(self._opened_at) + self._opening
+            idle = len(self._idle)
+            return PoolStats(
+                maxconn=self.maxconn,
+                size=size,
+                in_use=size - idle,
+                idle=idle,
+                checkouts=self._checkouts,
+                waits=self._waits,
+                wait_seconds=round(self._wait_seconds, 3),
+                max_wait_seconds=round(self._max_wait_seconds, 3),
+                recycled=self._recycled,
+                discarded=self._discarded,
+            )
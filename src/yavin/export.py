@@ -0,0 +1,99 @@
+import csv
+import datetime
+import decimal
+import io
+import json
+import uuid
+from collections.abc import Iterable, Iterator, Mapping, Sequence
+
+import yavin.db
+import yavin.db.mirror
+
+# table -> permission needed to export it. Library credentials, settings and user
+# permissions hold secrets or access control, so they can't be exported.
+TABLE_PERMISSIONS: dict[str, str] = {
+    "balances_accounts": "balances",
+    "balances_transactions": "balances",
+    "billboard_number_one": "billboard",
+    "callings": "callings",
+    "captains_log": "captains-log",
+    "electricity": "electricity",
+    "jar_entries": "jar",
+    "library_books": "library",
+    "mileage_entries": "mileage",
+    "movie_people": "movie-night",
+    "movie_picks": "movie-night",
+    "phone_usage": "phone",
+    "tithing_income": "tithing",
+    "weight_entries": "weight",
+}
+
+EXPENSES_COLUMNS = ("account", "post_date", "description", "memo", "amount")
+
+# format -> mimetype
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def table_chunks(
+    db: yavin.db.YavinDatabase, table: str, chunk_size: int = 1000
+) -> Iterator[list]:
+    """Stream a table from Postgres with a server-side cursor, in primary key order
+    when the table has one"""
+    cols = ", ".join(yavin.db.mirror.TABLES[table])
+    sql = f"select {cols} from {table}"  # noqa: S608
+    if keys := yavin.db.mirror.PRIMARY_KEYS.get(table):
+        sql = f"{sql} order by {', '.join(keys)}"
+    return db.q_iter(sql, chunk_size=chunk_size)
+
+
+def _json_default(o: object) -> str:
+    if isinstance(o, datetime.date | datetime.datetime):
+        return o.isoformat()
+    # Decimals are written as strings so no precision is lost
+    if isinstance(o, decimal.Decimal | uuid.UUID):
+        return str(o)
+    raise TypeError(f"Can't export {type(o).__name__}")
+
+
+def _csv_value(value: object) -> object:
+    if isinstance(value, datetime.date | datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def csv_lines(
+    columns: Sequence[str], chunks: Iterable[Sequence[Mapping]]
+) -> Iterator[str]:
+    """Write a header, then one string per chunk of rows, so only one chunk is in
+    memory at a time"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    yield buf.getvalue()
+    for chunk in chunks:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows([_csv_value(row[c]) for c in columns] for row in chunk)
+        yield buf.getvalue()
+
+
+def ndjson_lines(
+    columns: Sequence[str], chunks: Iterable[Sequence[Mapping]]
+) -> Iterator[str]:
+    """Write one JSON object per line, one string per chunk of rows"""
+    for chunk in chunks:
+        yield "".join(
+            json.dumps({c: row[c] for c in columns}, default=_json_default) + "\n"
+            for row in chunk
+        )
+
+
+def lines(
+    fmt: str, columns: Sequence[str], chunks: Iterable[Sequence[Mapping]]
+) -> Iterator[str]:
+    if fmt == "csv":
+        return csv_lines(columns, chunks)
+    return ndjson_lines(columns, chunks)
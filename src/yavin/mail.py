@@ -0,0 +1,106 @@
+import email.message
+import logging
+import smtplib
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Seconds an unused SMTP connection is kept open in case another message follows
+SMTP_IDLE_TIMEOUT = 60.0
+# Seconds to wait for the SMTP server on each command
+SMTP_TIMEOUT = 30.0
+
+
+def is_message_error(exc: Exception) -> bool:
+    """Whether the server refused one message, as opposed to the connection or login
+    failing. Other messages can still be sent on the same connection."""
+    return isinstance(
+        exc,
+        (
+            smtplib.SMTPRecipientsRefused,
+            smtplib.SMTPSenderRefused,
+            smtplib.SMTPDataError,
+        ),
+    )
+
+
+class SMTPSender:
+    """Sends messages over one SMTP_SSL connection that is kept open between messages.
+    The connection is closed once it has been idle for `idle_timeout` seconds, or
+    replaced when the server, username or password changes."""
+
+    def __init__(self, idle_timeout: float = SMTP_IDLE_TIMEOUT) -> None:
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._smtp: smtplib.SMTP | None = None
+        self._config: tuple[str, str, str] | None = None
+        self._last_used = 0.0
+
+    def _close(self) -> None:
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except smtplib.SMTPException, OSError:
+            self._smtp.close()
+        self._smtp = None
+        self._config = None
+
+    def _idle(self) -> bool:
+        return time.monotonic() - self._last_used > self.idle_timeout
+
+    def _session(self, config: tuple[str, str, str]) -> smtplib.SMTP:
+        if self._smtp is not None and (self._config != config or self._idle()):
+            self._close()
+        if self._smtp is None:
+            host, username, password = config
+            log.debug(f"Connecting to SMTP server {host}")
+            smtp = smtplib.SMTP_SSL(host=host, timeout=SMTP_TIMEOUT)
+            try:
+                smtp.login(user=username, password=password)
+            except BaseException:
+                smtp.close()
+                raise
+            self._smtp = smtp
+            self._config = config
+        return self._smtp
+
+    def send(
+        self, msg: email.message.EmailMessage, host: str, username: str, password: str
+    ) -> None:
+        config = (host, username, password)
+        with self._lock:
+            reconnected = False
+            while True:
+                smtp = self._session(config)
+                try:
+                    smtp.send_message(msg)
+                except smtplib.SMTPServerDisconnected:
+                    self._close()
+                    if reconnected:
+                        raise
+                    # The server may have dropped a connection we thought was open
+                    reconnected = True
+                    continue
+                except Exception as e:
+                    if not is_message_error(e):
+                        self._close()
+                    raise
+                self._last_used = time.monotonic()
+                return
+
+    def close_if_idle(self) -> None:
+        # Don't wait for a send in progress, it will leave the connection fresh
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._smtp is not None and self._idle():
+                log.debug("Closing idle SMTP connection")
+                self._close()
+        finally:
+            self._lock.release()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
@@ -0,0 +1,161 @@
+import logging
+import re
+import threading
+import time
+
+import httpx
+import jwt
+
+log = logging.getLogger(__name__)
+
+# Seconds to cache a document when the provider doesn't send a usable max-age
+DEFAULT_MAX_AGE = 3600.0
+# Keep documents at least this long even if the provider asks for less, and never
+# longer than MAX_MAX_AGE
+MIN_MAX_AGE = 60.0
+MAX_MAX_AGE = 86400.0
+# Refresh in the background once this fraction of a document's max-age has passed
+REFRESH_AFTER = 0.75
+# When a token is signed with a key we don't have, fetch the key set again, but not
+# more often than this many seconds
+UNKNOWN_KEY_REFETCH_INTERVAL = 60.0
+
+
+def _max_age(resp: httpx.Response) -> float:
+    cache_control = resp.headers.get("Cache-Control", "")
+    if m := re.search(r"max-age=(\d+)", cache_control):
+        max_age = float(m.group(1))
+    else:
+        max_age = DEFAULT_MAX_AGE
+    return min(max(max_age, MIN_MAX_AGE), MAX_MAX_AGE)
+
+
+class CachedDocument:
+    """A JSON document fetched over HTTP and kept for as long as its Cache-Control
+    max-age allows. Once most of that time has passed, the next get() returns the
+    cached copy and refreshes it in a background thread. Only an expired or missing
+    document makes the caller wait for the network."""
+
+    def __init__(self, http: httpx.Client, name: str) -> None:
+        self.http = http
+        self.name = name
+        self._lock = threading.Lock()
+        self._url: str | None = None
+        self._value: dict | None = None
+        self._fetched_at = 0.0
+        self._max_age = 0.0
+        self._refreshing = False
+
+    def _fetch(self, url: str) -> dict:
+        log.info(f"Fetching OpenID {self.name} from {url}")
+        resp = self.http.get(url)
+        resp.raise_for_status()
+        value = resp.json()
+        with self._lock:
+            self._url = url
+            self._value = value
+            self._fetched_at = time.monotonic()
+            self._max_age = _max_age(resp)
+        return value
+
+    def _refresh(self, url: str) -> None:
+        try:
+            self._fetch(url)
+        except httpx.HTTPError, ValueError:
+            # Keep serving the cached copy until it expires
+            log.exception(f"Error refreshing OpenID {self.name}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get(self, url: str) -> dict:
+        with self._lock:
+            value = self._value
+            age = time.monotonic() - self._fetched_at
+            if value is None or self._url != url or age >= self._max_age:
+                value = None
+            elif age >= self._max_age * REFRESH_AFTER and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(
+                    target=self._refresh,
+                    args=[url],
+                    name=f"openid-{self.name}",
+                    daemon=True,
+                ).start()
+        if value is None:
+            value = self._fetch(url)
+        return value
+
+    def fetched_seconds_ago(self) -> float:
+        with self._lock:
+            return time.monotonic() - self._fetched_at
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._value = None
+
+
+class Provider:
+    """The OpenID Connect provider that users sign in with. The discovery document
+    and signing keys are cached, so signing a user in only needs the token request."""
+
+    def __init__(self, discovery_url: str, client_id: str) -> None:
+        self.discovery_url = discovery_url
+        self.client_id = client_id
+        self.http = httpx.Client(timeout=10.0)
+        self._discovery = CachedDocument(self.http, "discovery document")
+        self._jwks = CachedDocument(self.http, "signing keys")
+
+    def discovery(self) -> dict:
+        return self._discovery.get(self.discovery_url)
+
+    def _jwks_uri(self) -> str:
+        return self.discovery()["jwks_uri"]
+
+    def _find_key(self, kid: str | None) -> jwt.PyJWK | None:
+        jwks = jwt.PyJWKSet.from_dict(self._jwks.get(self._jwks_uri()))
+        return next((key for key in jwks.keys if key.key_id == kid), None)
+
+    def _signing_key(self, kid: str | None) -> jwt.PyJWK:
+        key = self._find_key(kid)
+        # The provider may have rotated its keys since we fetched them
+        if (
+            key is None
+            and self._jwks.fetched_seconds_ago() >= UNKNOWN_KEY_REFETCH_INTERVAL
+        ):
+            self._jwks.invalidate()
+            key = self._find_key(kid)
+        if key is None:
+            raise jwt.InvalidKeyError(f"Unknown signing key {kid}")
+        return key
+
+    def decode_id_token(self, id_token: str) -> dict:
+        """Verify the ID token's signature, audience, issuer and expiry, and return
+        its claims. Raises jwt.PyJWTError if any check fails."""
+        discovery = self.discovery()
+        header = jwt.get_unverified_header(id_token)
+        key = self._signing_key(header.get("kid"))
+        algorithms = [
+            alg
+            for alg in discovery.get("id_token_signing_alg_values_supported", [])
+            if alg != "none"
+        ]
+        return jwt.decode(
+            id_token,
+            key=key,
+            algorithms=algorithms,
+            audience=self.client_id,
+            issuer=discovery.get("issuer"),
+        )
+
+    def prefetch(self) -> None:
+        """Fetch the discovery document and signing keys in the background, so the
+        first user to sign in doesn't wait for them"""
+
+        def fetch() -> None:
+            try:
+                self._jwks.get(self._jwks_uri())
+            except httpx.HTTPError, KeyError, ValueError:
+                log.exception("Error fetching OpenID provider configuration")
+
+        threading.Thread(target=fetch, name="openid-prefetch", daemon=True).start()
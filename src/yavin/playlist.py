@@ -4,18 +4,33 @@ YouTube Music album page for each song in the playlist."""
 
 import argparse
 import collections
+import concurrent.futures
 import csv
+import functools
 import logging
 import pathlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections.abc import Iterable
 
 import notch
 from ytmusicapi import YTMusic
+from ytmusicapi.exceptions import YTMusicServerError
 
 notch.configure()
 log = logging.getLogger(__name__)
 
 Song = collections.namedtuple("Song", "title artist album")
 
+# Failed searches are retried, waiting SEARCH_BACKOFF seconds and doubling
+SEARCH_ATTEMPTS = 3
+SEARCH_BACKOFF = 2.0
+# Albums that weren't found are searched for again after this many seconds, in case
+# they have been added since. Albums that were found are cached for good.
+NEGATIVE_TTL = 7 * 24 * 60 * 60
+
 
 def read_songs(path: pathlib.Path) -> list[Song]:
     """Read songs from a CSV with Song, Artist, and Album columns."""
@@ -36,38 +51,163 @@ def read_songs(path: pathlib.Path) -> list[Song]:
     return songs
 
 
-def youtube_music_album_url(
-    ytmusic: YTMusic, album: str, artist: str, cache: dict[tuple[str, str], str]
-) -> str:
+def _normalise(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def album_key(song: Song) -> tuple[str, str]:
+    """Songs with the same album and primary artist share one lookup. Use only the
+    primary artist; a long comma-joined list of features makes the album search too
+    noisy to match. Case and spacing are normalised so small differences between
+    exports still match."""
+    return _normalise(song.album), _normalise(song.artist.split(",")[0])
+
+
+class LookupCache:
+    """Album URLs from earlier runs, kept in a SQLite file. An empty URL records an
+    album that wasn't found; those entries expire after NEGATIVE_TTL seconds."""
+
+    def __init__(self, path: pathlib.Path, refresh: bool = False) -> None:
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        # Lookups finish on worker threads, so writes are serialized with a lock
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False)
+        self._con.execute("""
+            create table if not exists album_urls (
+                album text not null,
+                artist text not null,
+                url text not null,
+                looked_up_at real not null,
+                primary key (album, artist)
+            )
+        """)
+        self._con.commit()
+
+    def get(self, key: tuple[str, str]) -> str | None:
+        """Return the cached URL for an album, or None if it needs to be looked up"""
+        row = None
+        if not self.refresh:
+            sql = """
+                select url
+                from album_urls
+                where album = :album and artist = :artist
+                and (url != '' or looked_up_at > :negative_cutoff)
+            """
+            params = {
+                "album": key[0],
+                "artist": key[1],
+                "negative_cutoff": time.time() - NEGATIVE_TTL,
+            }
+            with self._lock:
+                row = self._con.execute(sql, params).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: tuple[str, str], url: str) -> None:
+        sql = """
+            insert into album_urls (album, artist, url, looked_up_at)
+            values (:album, :artist, :url, :looked_up_at)
+            on conflict (album, artist) do update
+            set url = excluded.url, looked_up_at = excluded.looked_up_at
+        """
+        params = {
+            "album": key[0],
+            "artist": key[1],
+            "url": url,
+            "looked_up_at": time.time(),
+        }
+        with self._lock:
+            self._con.execute(sql, params)
+            self._con.commit()
+
+    def close(self) -> None:
+        self._con.close()
+
+
+class RateLimiter:
+    """Space calls from any number of threads at least 1 / `rate` seconds apart"""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+def youtube_music_album_url(ytmusic: YTMusic, album: str, primary_artist: str) -> str:
     """Return the YouTube Music album page URL, or "" if nothing matches."""
-    log.debug(f"Current cache size: {len(cache)}")
-    key = (album, artist)
-    if key in cache:
-        return cache[key]
-    result = ""
-    if album:
-        # Use only the primary artist; a long comma-joined list of features makes
-        # the album search too noisy to match.
-        primary_artist = artist.split(",")[0].strip()
-        query = f"{album} {primary_artist}".strip()
-        hits = ytmusic.search(query, filter="albums")
-        if hits and hits[0].get("browseId"):
-            result = f"https://music.youtube.com/browse/{hits[0]['browseId']}"
-    cache[key] = result
-    return result
-
-
-def write_csv(path: pathlib.Path, rows: list[tuple[Song, str]]) -> None:
+    if not album:
+        return ""
+    query = f"{album} {primary_artist}".strip()
+    hits = ytmusic.search(query, filter="albums")
+    if hits and hits[0].get("browseId"):
+        return f"https://music.youtube.com/browse/{hits[0]['browseId']}"
+    return ""
+
+
+class AlbumResolver:
+    """Look up album URLs from several threads. Each thread gets its own YTMusic
+    client, searches are rate limited across all of them, and transient failures are
+    retried."""
+
+    def __init__(self, limiter: RateLimiter) -> None:
+        self.limiter = limiter
+        self._local = threading.local()
+
+    def _ytmusic(self) -> YTMusic:
+        if not hasattr(self._local, "ytmusic"):
+            self._local.ytmusic = YTMusic()
+        return self._local.ytmusic
+
+    def resolve(self, key: tuple[str, str]) -> str:
+        album, primary_artist = key
+        if not album:
+            return ""
+        attempt = 1
+        while True:
+            self.limiter.wait()
+            try:
+                return youtube_music_album_url(self._ytmusic(), album, primary_artist)
+            except YTMusicServerError, OSError:
+                if attempt >= SEARCH_ATTEMPTS:
+                    raise
+                delay = SEARCH_BACKOFF * 2 ** (attempt - 1)
+                log.warning(f"Search for {key} failed, retrying in {delay}s")
+                time.sleep(delay)
+                attempt += 1
+
+
+def write_csv(path: pathlib.Path, rows: Iterable[tuple[Song, str]]) -> int:
+    """Write rows as they are produced and return how many were written"""
+    count = 0
     with path.open(mode="w", encoding="utf-8", newline="") as f:
         writer = csv.writer(f)
         writer.writerow(["Song", "Artist", "Album", "YouTube Music Link"])
         for song, link in rows:
             writer.writerow([song.title, song.artist, song.album, link])
+            f.flush()
+            count += 1
+    return count
 
 
 class Args:
+    cache_path: pathlib.Path
     input: pathlib.Path
     output: pathlib.Path
+    refresh: bool
+    rate: float
+    workers: int
 
 
 def parse_args() -> Args:
@@ -88,24 +228,87 @@ def parse_args() -> Args:
         default=pathlib.Path("out.csv"),
         help="Output CSV path (default: out.csv)",
     )
+    parser.add_argument(
+        "--cache-path",
+        type=pathlib.Path,
+        default=pathlib.Path("playlist-cache.db"),
+        help="SQLite file that keeps album links between runs "
+        "(default: playlist-cache.db)",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Look up every album again instead of using cached links",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of albums to look up at once (default: 4)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=5.0,
+        help="Maximum searches per second across all workers (default: 5)",
+    )
     return parser.parse_args(namespace=Args())
 
 
+def _rows(
+    songs: list[Song],
+    lookups: dict[tuple[str, str], concurrent.futures.Future[str]],
+) -> Iterable[tuple[Song, str]]:
+    """Yield each song with its link in input order, as soon as the lookups for it
+    and every song before it have finished"""
+    for song in songs:
+        key = album_key(song)
+        try:
+            link = lookups[key].result()
+        except YTMusicServerError, OSError:
+            log.exception(f"Could not look up {key}")
+            link = ""
+        yield song, link
+
+
+def _store(
+    cache: LookupCache, key: tuple[str, str], lookup: concurrent.futures.Future[str]
+) -> None:
+    # Failed lookups aren't cached, so they are tried again on the next run
+    if lookup.exception() is None:
+        cache.set(key, lookup.result())
+
+
 def main() -> None:
     args = parse_args()
 
     songs = read_songs(args.input)
-    log.info("Read %d songs; looking up YouTube Music albums", len(songs))
-
-    ytmusic = YTMusic()
-    cache: dict[tuple[str, str], str] = {}
-    rows = [
-        (song, youtube_music_album_url(ytmusic, song.album, song.artist, cache))
-        for song in songs
-    ]
+    keys = list(dict.fromkeys(album_key(song) for song in songs))
+    log.info("Read %d songs; looking up %d YouTube Music albums", len(songs), len(keys))
 
-    write_csv(args.output, rows)
-    log.info("Wrote %d songs to %s", len(rows), args.output)
+    cache = LookupCache(args.cache_path, args.refresh)
+    resolver = AlbumResolver(RateLimiter(args.rate))
+    lookups: dict[tuple[str, str], concurrent.futures.Future[str]] = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(args.workers, 1), thread_name_prefix="playlist"
+        ) as pool:
+            for key in keys:
+                url = cache.get(key)
+                if url is None:
+                    lookups[key] = pool.submit(resolver.resolve, key)
+                    lookups[key].add_done_callback(
+                        functools.partial(_store, cache, key)
+                    )
+                else:
+                    lookups[key] = concurrent.futures.Future()
+                    lookups[key].set_result(url)
+            count = write_csv(args.output, _rows(songs, lookups))
+    finally:
+        cache.close()
+    log.info("Wrote %d songs to %s", count, args.output)
+    log.info("Cache hits: %d, misses: %d", cache.hits, cache.misses)
 
 
 if __name__ == "__main__":
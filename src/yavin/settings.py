@@ -10,6 +10,8 @@ class Settings:
     admin_email: str
     backdoor_enabled: bool
     database: str
+    db_pool_max_age: float
+    db_pool_timeout: float
     dsn: str
     openid_client_id: str
     openid_client_secret: str
@@ -24,14 +26,17 @@ class Settings:
         """Instantiating a Settings object will automatically read the following
         environment variables:
 
-        ADMIN_AUTH_PHRASE, ADMIN_EMAIL, BACKDOOR_ENABLED, DATABASE, DSN,
-        OPENID_CLIENT_ID, OPENID_CLIENT_SECRET, OPENID_DISCOVERY_DOCUMENT, PORT, SCHEME,
-        SECRET_KEY, SERVER_NAME, WEB_SERVER_THREADS
+        ADMIN_AUTH_PHRASE, ADMIN_EMAIL, BACKDOOR_ENABLED, DATABASE, DB_POOL_MAX_AGE,
+        DB_POOL_TIMEOUT, DSN, OPENID_CLIENT_ID, OPENID_CLIENT_SECRET,
+        OPENID_DISCOVERY_DOCUMENT, PORT, SCHEME, SECRET_KEY, SERVER_NAME,
+        WEB_SERVER_THREADS
 
         Some variables have defaults if they are not found in the environment:
 
         BACKDOOR_ENABLED="false"
         DATABASE="/etc/yavin/yavin.db"
+        DB_POOL_MAX_AGE="1800"
+        DB_POOL_TIMEOUT="30"
         PORT="8080"
         SCHEME="http"
         SERVER_NAME="localhost:8080"
@@ -42,6 +47,8 @@ class Settings:
         self.admin_email = os.getenv("ADMIN_EMAIL", "")
         self.backdoor_enabled = _as_bool(os.getenv("BACKDOOR_ENABLED", "false"))
         self.database = os.getenv("DATABASE", "/etc/yavin/yavin.db")
+        self.db_pool_max_age = float(os.getenv("DB_POOL_MAX_AGE", "1800"))
+        self.db_pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "30"))
         self.dsn = os.getenv("DSN", "")
         self.openid_client_id = os.getenv("OPENID_CLIENT_ID", "")
         self.openid_client_secret = os.getenv("OPENID_CLIENT_SECRET", "")
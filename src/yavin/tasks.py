@@ -1,7 +1,11 @@
+import concurrent.futures
+import dataclasses
 import email.message
 import email.utils
+import itertools
 import logging
-import smtplib
+import time
+from collections.abc import Callable
 
 import apscheduler.schedulers.background
 import bibliocommons
@@ -11,117 +15,474 @@ import httpx
 import yavin.billboard
 import yavin.components
 import yavin.db
+import yavin.db.app_sqlite
+import yavin.db.mirror
+import yavin.mail
 import yavin.settings
 import yavin.util
 
 log = logging.getLogger(__name__)
 scheduler = apscheduler.schedulers.background.BackgroundScheduler()
 
+# Libraries are synced in parallel, so one slow library doesn't hold up the rest
+LIBRARY_SYNC_WORKERS = 4
+# Seconds to wait for each request to a library
+LIBRARY_SYNC_TIMEOUT = 30.0
+# Seconds one credential may spend logging in, paging through loans and retrying
+LIBRARY_SYNC_DEADLINE = 180.0
+# Transient failures are retried, waiting LIBRARY_SYNC_BACKOFF seconds and doubling
+LIBRARY_SYNC_ATTEMPTS = 3
+LIBRARY_SYNC_BACKOFF = 5.0
+# Connections in the pool shared by every task, enough for a library sync to run
+# alongside other tasks
+TASK_DB_MAXCONN = 8
+# Messages sent in each batch by email_send
+EMAIL_BATCH_SIZE = 20
+# Failed messages are retried, waiting EMAIL_BACKOFF seconds and doubling
+EMAIL_ATTEMPTS = 6
+EMAIL_BACKOFF = 60.0
 
-def _notify(subject: str, body: str) -> None:
-    settings = yavin.settings.Settings()
-    db = yavin.db.YavinDatabase(settings.dsn)
-    app_settings = db.settings_list()
-    msg = email.message.EmailMessage()
-    msg["Message-ID"] = email.utils.make_msgid()
-    msg["Date"] = email.utils.formatdate()
-    msg["Subject"] = subject
-    msg["From"] = app_settings.get("smtp_from_address", "")
-    msg["To"] = settings.admin_email
-    msg.set_content(body, subtype="html")
-    if "smtp_server" in app_settings:
-        with smtplib.SMTP_SSL(host=app_settings.get("smtp_server", "")) as s:
-            s.login(
-                user=app_settings.get("smtp_username", ""),
-                password=app_settings.get("smtp_password", ""),
-            )
-            s.send_message(msg)
-    else:
-        log.warning("Can't send email. SMTP server is not configured")
 
+@dataclasses.dataclass
+class TaskContext:
+    """The settings, database handle, HTTP client and SMTP connection shared by every
+    task run in a process. The worker creates one and passes it to each task."""
+
+    settings: yavin.settings.Settings
+    db: yavin.db.YavinDatabase
+    http: httpx.Client
+    smtp: yavin.mail.SMTPSender
+
+    @classmethod
+    def create(cls, settings: yavin.settings.Settings) -> TaskContext:
+        db = yavin.db.YavinDatabase(
+            settings.dsn,
+            maxconn=TASK_DB_MAXCONN,
+            max_age=settings.db_pool_max_age,
+            timeout=settings.db_pool_timeout,
+        )
+        http = httpx.Client(follow_redirects=True, timeout=30.0)
+        return cls(settings, db, http, yavin.mail.SMTPSender())
 
-def billboard_number_one_fetch() -> None:
-    song = yavin.billboard.fetch_number_one()
+    def close(self) -> None:
+        self.smtp.close()
+        self.http.close()
+        self.db.p.closeall()
 
-    settings = yavin.settings.Settings()
-    db = yavin.db.YavinDatabase(settings.dsn)
+
+def _notify(ctx: TaskContext, subject: str, body: str) -> None:
+    """Queue an email to the admin. The email_send task delivers it."""
+    ctx.db.email_outbox_insert(subject, body, ctx.settings.admin_email)
+    enqueue(ctx.db, "email_send")
+
+
+def email_send(ctx: TaskContext) -> None:
+    """Deliver the messages in the outbox that are due, in batches over one SMTP
+    connection"""
+    app_settings = ctx.db.settings_list()
+    if "smtp_server" not in app_settings:
+        log.warning("Can't send email. SMTP server is not configured")
+        return
+    host = app_settings.get("smtp_server", "")
+    username = app_settings.get("smtp_username", "")
+    password = app_settings.get("smtp_password", "")
+    while batch := ctx.db.email_outbox_claim(EMAIL_BATCH_SIZE):
+        # After the connection or login fails, the rest of the batch would only fail
+        # the same way, so it is put back with the same error
+        connection_error = None
+        for message in batch:
+            id_ = message["id"]
+            if connection_error is None:
+                msg = email.message.EmailMessage()
+                msg["Message-ID"] = email.utils.make_msgid()
+                msg["Date"] = email.utils.format_datetime(message["created_at"])
+                msg["Subject"] = message["subject"]
+                msg["From"] = app_settings.get("smtp_from_address", "")
+                msg["To"] = message["to_address"]
+                msg.set_content(message["body"], subtype="html")
+                try:
+                    ctx.smtp.send(msg, host, username, password)
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+                    if not yavin.mail.is_message_error(e):
+                        connection_error = error
+                else:
+                    latency = ctx.db.email_outbox_sent(id_)
+                    log.info(f"Sent email {id_} after {latency}s in the outbox")
+                    continue
+            else:
+                error = connection_error
+            if message["attempts"] < EMAIL_ATTEMPTS:
+                retry_in = EMAIL_BACKOFF * 2 ** (message["attempts"] - 1)
+                log.warning(f"Sending email {id_} failed, retrying in {retry_in}s")
+            else:
+                retry_in = None
+                log.error(f"Giving up on email {id_}: {error}")
+            ctx.db.email_outbox_failed(id_, error, retry_in)
+        if connection_error is not None:
+            raise RuntimeError(connection_error)
+
+
+def billboard_number_one_fetch(ctx: TaskContext) -> None:
+    db = ctx.db
     latest = db.billboard_get_latest()
-    if latest and song == (latest.get("artist"), latest.get("title")):
-        db.billboard_update_fetched_at(latest.get("id"))
+    if latest is None:
+        result = yavin.billboard.fetch_number_one(ctx.http)
     else:
-        db.billboard_insert(song.artist, song.title)
+        result = yavin.billboard.fetch_number_one(
+            ctx.http, latest["etag"], latest["last_modified"]
+        )
+    song = result.song
+
+    if song is None and latest is None:
+        # Only a conditional fetch should come back unchanged
+        log.warning("Billboard Hot 100 was not modified, but no #1 has been saved")
+    elif latest is not None and (
+        song is None or song == (latest["artist"], latest["title"])
+    ):
+        db.billboard_update_fetched_at(latest["id"], result.etag, result.last_modified)
+    elif song is not None:
+        db.billboard_insert(song.artist, song.title, result.etag, result.last_modified)
         subject = "New Billboard Hot 100 #1"
-        _notify(subject, yavin.components.email_billboard(song.title, song.artist))
+        _notify(ctx, subject, yavin.components.email_billboard(song.title, song.artist))
 
 
-def library_notify() -> None:
+def library_notify(ctx: TaskContext) -> None:
     log.info("Checking for due library items")
-    settings = yavin.settings.Settings()
-    db = yavin.db.YavinDatabase(settings.dsn)
-    due_books = db.library_books_list_due()
+    due_books = ctx.db.library_books_list_due()
     if due_books:
         log.info("Sending notification email")
         subject = "Library alert"
-        _notify(subject, yavin.components.email_library_item_due(due_books))
+        _notify(ctx, subject, yavin.components.email_library_item_due(due_books))
     else:
         log.info("No due library items found")
 
 
-def library_sync() -> None:
+def library_sync(ctx: TaskContext) -> None:
     log.info("Syncing library data")
-    settings = yavin.settings.Settings()
-    db = yavin.db.YavinDatabase(settings.dsn)
-    db.library_books_truncate()
-    for lib_cred in db.library_credentials_list():
-        lib_type = lib_cred.get("library_type")
-        display_name = lib_cred.get("display_name")
-        log.info(f"Syncing library data for {display_name}")
+    db = ctx.db
+    credentials = db.library_credentials_list()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=LIBRARY_SYNC_WORKERS, thread_name_prefix="library-sync"
+    ) as pool:
+        list(
+            pool.map(
+                library_sync_credential,
+                credentials,
+                itertools.repeat(db),
+                itertools.repeat(ctx.settings.secret_key),
+            )
+        )
+
+
+class LibrarySyncTimeout(TimeoutError):
+    """A library credential took longer than LIBRARY_SYNC_DEADLINE to sync"""
+
+
+def _library_timeout() -> LibrarySyncTimeout:
+    return LibrarySyncTimeout(f"Timed out after {LIBRARY_SYNC_DEADLINE:.0f}s")
+
+
+def _apply_deadline(client: httpx.Client, deadline: float) -> None:
+    """Stop a library client sending requests once `deadline` (a time.monotonic()
+    value) has passed, and cut each request's timeout short so it ends by then"""
+
+    def check_deadline(request: httpx.Request) -> None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise _library_timeout()
+        timeout = httpx.Timeout(min(LIBRARY_SYNC_TIMEOUT, remaining))
+        request.extensions["timeout"] = timeout.as_dict()
+
+    client.timeout = httpx.Timeout(LIBRARY_SYNC_TIMEOUT)
+    client.event_hooks["request"].append(check_deadline)
+
+
+def _cookies_dump(client: httpx.Client) -> list[dict]:
+    return [
+        {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path}
+        for c in client.cookies.jar
+    ]
+
+
+def _cookies_load(client: httpx.Client, cookies: list[dict]) -> None:
+    for c in cookies:
+        client.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"])
+
+
+def _is_transient(exc: Exception) -> bool:
+    if isinstance(exc, httpx.TransportError):
+        return True
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code >= 500
+
+
+def _library_loans(
+    lib_cred: yavin.db.app.LibraryCredential,
+    db: yavin.db.YavinDatabase,
+    secret_key: str,
+    deadline: float,
+) -> list[dict]:
+    """Get the loans for one library credential. A saved session is reused when there
+    is one, and the credential only authenticates again if the library rejects it."""
+    lib_type = lib_cred.get("library_type")
+    if lib_type == "biblionix":
+        sync = library_sync_biblionix
+    elif lib_type == "bibliocommons":
+        sync = library_sync_bibliocommons
+    else:
+        raise ValueError(f"Library type {lib_type} is not implemented yet")
+
+    credential_id = lib_cred.get("id")
+    display_name = lib_cred.get("display_name")
+    session = None
+    if secret_key:
+        session = db.library_sessions_get(credential_id, secret_key)
+    if session is not None:
         try:
-            if lib_type == "biblionix":
-                library_sync_biblionix(lib_cred, db)
-            elif lib_type == "bibliocommons":
-                library_sync_bibliocommons(lib_cred, db)
-            else:
-                log.warning(f"Library type {lib_type} is not implemented yet")
-        except httpx.ReadTimeout:
-            log.error(f"Library sync timed out for {display_name}")
+            loans, session = sync(lib_cred, session, deadline)
+        except LibrarySyncTimeout:
+            raise
+        except Exception as e:
+            if _is_transient(e):
+                raise
+            log.info(f"Saved session for {display_name} was rejected ({e!r})")
+            db.library_sessions_delete(credential_id)
+        else:
+            # An expired session can look like an account with nothing checked out
+            if loans:
+                # Keep any cookies the library rotated
+                db.library_sessions_set(credential_id, session, secret_key)
+                return loans
+            log.info(f"No loans with the saved session for {display_name}")
+    log.info(f"Authenticating to {display_name}")
+    loans, session = sync(lib_cred, None, deadline)
+    if secret_key:
+        db.library_sessions_set(credential_id, session, secret_key)
+    return loans
 
 
-def library_sync_bibliocommons(
-    lib_data: yavin.db.app.LibraryCredential, db: yavin.db.YavinDatabase
+def _library_loans_with_retry(
+    lib_cred: yavin.db.app.LibraryCredential,
+    db: yavin.db.YavinDatabase,
+    secret_key: str,
+    deadline: float,
+) -> list[dict]:
+    display_name = lib_cred.get("display_name")
+    attempt = 1
+    while True:
+        try:
+            return _library_loans(lib_cred, db, secret_key, deadline)
+        except httpx.HTTPError as e:
+            if attempt >= LIBRARY_SYNC_ATTEMPTS or not _is_transient(e):
+                raise
+            delay = LIBRARY_SYNC_BACKOFF * 2 ** (attempt - 1)
+            if time.monotonic() + delay >= deadline:
+                raise _library_timeout() from e
+            log.warning(
+                f"Library sync for {display_name} failed ({e!r}), retrying in {delay}s"
+            )
+            time.sleep(delay)
+            attempt += 1
+
+
+def library_sync_credential(
+    lib_cred: yavin.db.app.LibraryCredential,
+    db: yavin.db.YavinDatabase,
+    secret_key: str,
 ) -> None:
+    """Sync the loans for one library credential and record how long it took. A
+    failure is logged and recorded, and never stops other credentials syncing."""
+    display_name = lib_cred.get("display_name")
+    log.info(f"Syncing library data for {display_name}")
+    start = time.monotonic()
+    error = None
+    try:
+        loans = _library_loans_with_retry(
+            lib_cred, db, secret_key, start + LIBRARY_SYNC_DEADLINE
+        )
+        counts = db.library_books_sync(lib_cred.get("id"), loans)
+        log.info(
+            f"Library sync for {display_name}: {counts.get('inserted')} inserted, "
+            f"{counts.get('updated')} updated, {counts.get('deleted')} deleted"
+        )
+    except Exception as e:
+        # Keep the books we already know about until the next successful sync
+        log.exception(f"Library sync failed for {display_name}")
+        error = str(e) or type(e).__name__
+    seconds = time.monotonic() - start
+    log.info(f"Library sync for {display_name} took {seconds:.1f}s")
+    db.library_credentials_set_sync_result(lib_cred.get("id"), seconds, error)
+
+
+def library_sync_bibliocommons(
+    lib_data: yavin.db.app.LibraryCredential,
+    session: dict | None,
+    deadline: float,
+) -> tuple[list[dict], dict]:
+    """Get the loans for a BiblioCommons account, authenticating unless a saved
+    session is given, and sending no requests after `deadline`. Returns the loans
+    and the session state to save."""
     lib_url = lib_data.get("library")
     bc = bibliocommons.BiblioCommonsClient(lib_url)
-    bc.authenticate(lib_data.get("username"), lib_data.get("password"))
+    _apply_deadline(bc.httpx_client, deadline)
+    if session is None:
+        bc.authenticate(lib_data.get("username"), lib_data.get("password"))
+    else:
+        _cookies_load(bc.httpx_client, session["cookies"])
+        bc.httpx_client.headers.update(session["headers"])
+        bc.account_id = session["account_id"]
+    loans = []
     for item in bc.loans:
         if item.subtitle:
             title = f"{item.title} / {item.subtitle}"
         else:
             title = item.title
-        params = {
-            "credential_id": lib_data.get("id"),
-            "due": item.due,
-            "item_id": item.item_id,
-            "medium": item.medium,
-            "renewable": item.renewable,
-            "title": title,
-        }
-        db.library_books_insert(params)
+        loans.append(
+            {
+                "due": item.due,
+                "item_id": item.item_id,
+                "medium": item.medium,
+                "renewable": item.renewable,
+                "title": title,
+            }
+        )
+    session = {
+        "account_id": bc.account_id,
+        "cookies": _cookies_dump(bc.httpx_client),
+        "headers": {
+            k: bc.httpx_client.headers[k] for k in ("X-Access-Token", "X-Session-Id")
+        },
+    }
+    return loans, session
 
 
 def library_sync_biblionix(
-    lib_data: yavin.db.app.LibraryCredential, db: yavin.db.YavinDatabase
-) -> None:
+    lib_data: yavin.db.app.LibraryCredential,
+    session: dict | None,
+    deadline: float,
+) -> tuple[list[dict], dict]:
+    """Get the loans for a Biblionix account, authenticating unless a saved session
+    is given, and sending no requests after `deadline`. Returns the loans and the
+    session state to save."""
     lib_url = lib_data.get("library")
     bc = biblionix.BiblionixClient(lib_url)
-    bc.authenticate(lib_data.get("username"), lib_data.get("password"))
-    for item in bc.loans:
-        params = {
-            "credential_id": lib_data.get("id"),
+    _apply_deadline(bc.httpx_client, deadline)
+    if session is None:
+        bc.authenticate(lib_data.get("username"), lib_data.get("password"))
+    else:
+        _cookies_load(bc.httpx_client, session["cookies"])
+        bc.session_key = session["session_key"]
+    loans = [
+        {
             "due": item.due,
             "item_id": item.item_id,
             "medium": item.medium,
             "renewable": item.renewable,
             "title": item.title,
         }
-        db.library_books_insert(params)
+        for item in bc.loans
+    ]
+    session = {
+        "cookies": _cookies_dump(bc.httpx_client),
+        "session_key": bc.session_key,
+    }
+    return loans, session
+
+
+def mirror_export(ctx: TaskContext) -> None:
+    log.info("Exporting data to the SQLite mirror")
+    con = yavin.db.app_sqlite.connection_get(ctx.settings.database)
+    try:
+        yavin.db.mirror.export(ctx.db, con)
+    finally:
+        con.close()
+
+
+def mirror_changes_prune(ctx: TaskContext) -> None:
+    """Keep the mirror change log from growing without limit when mirror_sync isn't
+    scheduled. The mirror may not have applied the pruned changes, so its next sync
+    exports everything."""
+    if not ctx.db.mirror_changes_prune():
+        return
+    log.info("Pruned old mirror changes, the next mirror sync will be a full export")
+    con = yavin.db.app_sqlite.connection_get(ctx.settings.database)
+    try:
+        yavin.db.app_sqlite.migrate(con)
+        yavin.db.app_sqlite.mirror_state_delete(con)
+    finally:
+        con.close()
+
+
+def mirror_sync(ctx: TaskContext) -> None:
+    log.info("Syncing changes to the SQLite mirror")
+    con = yavin.db.app_sqlite.connection_get(ctx.settings.database)
+    try:
+        yavin.db.mirror.sync(ctx.db, con)
+    finally:
+        con.close()
+
+
+# Tasks that can be requested with enqueue() and run by the worker
+TASKS: dict[str, Callable[[TaskContext], None]] = {
+    "billboard_number_one_fetch": billboard_number_one_fetch,
+    "email_send": email_send,
+    "library_notify": library_notify,
+    "library_sync": library_sync,
+    "mirror_export": mirror_export,
+    "mirror_sync": mirror_sync,
+}
+
+
+def enqueue(db: yavin.db.YavinDatabase, task: str) -> None:
+    """Ask the worker to run a task. A request for a task that is already waiting to
+    start is merged into the waiting one. A request made while the task is running
+    makes it run once more afterward."""
+    if task not in TASKS:
+        raise ValueError(f"Unknown task {task}")
+    log.info(f"Requesting task {task}")
+    db.task_requests_insert(task)
+
+
+def run_request(ctx: TaskContext, id_: int, task: str) -> None:
+    log.info(f"Running task {task}")
+    start = time.monotonic()
+    error = None
+    try:
+        TASKS[task](ctx)
+    except Exception as e:
+        log.exception(f"Task {task} failed")
+        error = str(e) or type(e).__name__
+    seconds = time.monotonic() - start
+    log.info(f"Task {task} finished in {seconds:.1f}s")
+    ctx.db.task_requests_finish(id_, seconds, error)
+
+
+# job id -> (task, trigger arguments)
+_recurring_jobs: dict[str, tuple[str, dict]] = {
+    "billboard_fetch": (
+        "billboard_number_one_fetch",
+        {"trigger": "interval", "hours": 24},
+    ),
+    # Picks up messages that are due to be retried
+    "email_send": ("email_send", {"trigger": "interval", "minutes": 5}),
+    "library_sync": ("library_sync", {"trigger": "interval", "hours": 6}),
+    "library_notify": ("library_notify", {"trigger": "cron", "day": "*", "hour": "3"}),
+    # Applying the mirror change log regularly keeps it short
+    "mirror_sync": ("mirror_sync", {"trigger": "interval", "hours": 1}),
+}
+
+
+def schedule_recurring(db: yavin.db.YavinDatabase, enabled: bool) -> None:
+    """Add or remove the recurring jobs so they match the enabled flag. Jobs that are
+    already scheduled are left alone, so calling this often doesn't reset their
+    timers. Each job only enqueues its task."""
+    for job_id, (task, trigger) in _recurring_jobs.items():
+        job = scheduler.get_job(job_id)
+        if enabled and job is None:
+            log.info(f"Scheduling {task}")
+            if trigger["trigger"] == "interval":
+                trigger = {**trigger, "start_date": yavin.util.in_two_minutes()}
+            scheduler.add_job(enqueue, args=[db, task], id=job_id, **trigger)
+        elif not enabled and job is not None:
+            log.info(f"Unscheduling {task}")
+            scheduler.remove_job(job_id)
@@ -0,0 +1,109 @@
+import logging
+import signal
+import sys
+import time
+
+import notch
+import psycopg2
+import psycopg2.extensions
+
+import yavin
+import yavin.db
+import yavin.settings
+import yavin.tasks
+
+log = logging.getLogger(__name__)
+
+# Only the worker holding this session-level advisory lock runs tasks
+LEADER_LOCK_ID = 7_955_570_110
+# Seconds between attempts to become the leader
+LEADER_RETRY_INTERVAL = 30
+# Seconds between checks for new task requests
+POLL_INTERVAL = 2
+# Seconds between checks of the leader lock, the scheduled tasks setting and pruning
+RECONCILE_INTERVAL = 60
+
+
+def _wait_for_leadership(dsn: str) -> psycopg2.extensions.connection:
+    """Block until this worker holds the leader lock, and return the connection that
+    holds it. The lock is released if the connection closes, so the connection must
+    stay open for as long as this worker leads."""
+    cnx = psycopg2.connect(dsn)
+    cnx.autocommit = True
+    waiting = False
+    while True:
+        with cnx.cursor() as c:
+            c.execute("select pg_try_advisory_lock(%s)", (LEADER_LOCK_ID,))
+            if c.fetchone()[0]:
+                log.info("This worker is the leader")
+                return cnx
+        if not waiting:
+            log.info("Another worker is the leader, waiting to take over")
+            waiting = True
+        time.sleep(LEADER_RETRY_INTERVAL)
+
+
+def _still_leader(cnx: psycopg2.extensions.connection) -> bool:
+    try:
+        with cnx.cursor() as c:
+            c.execute("select 1")
+    except psycopg2.Error:
+        return False
+    return True
+
+
+def run(settings: yavin.settings.Settings) -> None:
+    lock_cnx = _wait_for_leadership(settings.dsn)
+    ctx = yavin.tasks.TaskContext.create(settings)
+    db = ctx.db
+    # The worker may start before the web server has created the tables it uses
+    db.migrate()
+    db.task_requests_interrupt()
+    yavin.tasks.scheduler.start()
+    last_reconcile = 0.0
+    try:
+        while True:
+            if time.monotonic() - last_reconcile > RECONCILE_INTERVAL:
+                if not _still_leader(lock_cnx):
+                    # Another worker may already have taken over
+                    log.critical("Lost the connection holding the leader lock")
+                    sys.exit(1)
+                app_settings = db.settings_list()
+                enabled = app_settings.get("scheduled_tasks_enabled") == "true"
+                yavin.tasks.schedule_recurring(db, enabled)
+                db.task_requests_prune()
+                db.email_outbox_prune()
+                yavin.tasks.mirror_changes_prune(ctx)
+                last_reconcile = time.monotonic()
+            while (request := db.task_requests_claim()) is not None:
+                # The request is already marked as started, so the job must run
+                # however long it waits for a free thread
+                yavin.tasks.scheduler.add_job(
+                    yavin.tasks.run_request,
+                    args=[ctx, request["id"], request["task"]],
+                    misfire_grace_time=None,
+                    coalesce=False,
+                )
+            ctx.smtp.close_if_idle()
+            time.sleep(POLL_INTERVAL)
+    finally:
+        yavin.tasks.scheduler.shutdown(wait=False)
+        ctx.close()
+        lock_cnx.close()
+
+
+def main() -> None:
+    notch.configure()
+    signal.signal(signal.SIGTERM, yavin.handle_sigterm)
+    settings = yavin.settings.Settings()
+    if settings.dsn == "":
+        log.critical(
+            "Missing environment variable DSN; I cannot start without a database"
+        )
+        return
+    log.info("Starting the Yavin worker")
+    run(settings)
+
+
+if __name__ == "__main__":
+    main()
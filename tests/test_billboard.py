@@ -0,0 +1,16 @@
+import pathlib
+
+import yavin.billboard
+
+HOT_100 = pathlib.Path(__file__).parent / "data" / "hot100.html"
+
+
+def test_parsers_agree() -> None:
+    content = HOT_100.read_bytes()
+    # Small chunks so the first chart item is split across several feeds
+    chunks = [content[i : i + 256] for i in range(0, len(content), 256)]
+    song = yavin.billboard.parse_number_one(chunks)
+    assert song == yavin.billboard.parse_number_one_document(content)
+    assert song == yavin.billboard.Song(
+        "HUNTR/X: EJAE, Audrey Nuna & REI AMI", "Golden"
+    )
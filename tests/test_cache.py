@@ -0,0 +1,37 @@
+import yavin.cache
+
+
+def test_set_skipped_after_invalidate() -> None:
+    cache: yavin.cache.TTLCache[str, str] = yavin.cache.TTLCache(60)
+    generation = cache.generation("a")
+    # Another thread writes and invalidates while the old value is being loaded
+    cache.invalidate("a")
+    cache.set("a", "stale", generation)
+    assert cache.get("a") is None
+    cache.set("a", "fresh", cache.generation("a"))
+    assert cache.get("a") == "fresh"
+
+
+def test_set_skipped_after_clear() -> None:
+    cache: yavin.cache.TTLCache[str, str] = yavin.cache.TTLCache(60)
+    cache.invalidate("a")
+    generation = cache.generation("a")
+    cache.clear()
+    cache.set("a", "stale", generation)
+    assert cache.get("a") is None
+    # Other keys are unaffected by an invalidation
+    generation = cache.generation("b")
+    cache.invalidate("a")
+    cache.set("b", "fresh", generation)
+    assert cache.get("b") == "fresh"
+
+
+def test_fragment_size_in_bytes() -> None:
+    fragments = yavin.cache.FragmentCache(10)
+    # Four characters, but seven bytes in UTF-8
+    fragments.get_or_render("a", lambda: "ééé!")
+    assert fragments.stats().bytes == 7
+    # Eleven bytes is over the cap, so the oldest fragment is evicted
+    fragments.get_or_render("b", lambda: "éé")
+    assert fragments.stats().size == 1
+    assert fragments.stats().bytes == 4
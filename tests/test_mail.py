@@ -0,0 +1,101 @@
+import email.message
+import smtplib
+
+import pytest
+
+import yavin.mail
+
+
+class FakeSMTP:
+    """Records what an SMTP_SSL connection was asked to do"""
+
+    def __init__(self, host: str, timeout: float) -> None:
+        self.host = host
+        self.logins: list[str] = []
+        self.sent: list[email.message.EmailMessage] = []
+        self.closed = False
+        # Set to make the next send fail as if the server had hung up
+        self.disconnected = False
+
+    def login(self, user: str, password: str) -> None:
+        self.logins.append(user)
+
+    def send_message(self, msg: email.message.EmailMessage) -> None:
+        if self.disconnected:
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        self.sent.append(msg)
+
+    def quit(self) -> None:
+        self.closed = True
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def connections(monkeypatch: pytest.MonkeyPatch) -> list[FakeSMTP]:
+    """Every connection opened during the test, oldest first"""
+    opened: list[FakeSMTP] = []
+
+    def smtp_ssl(host: str, timeout: float) -> FakeSMTP:
+        opened.append(FakeSMTP(host, timeout))
+        return opened[-1]
+
+    monkeypatch.setattr(yavin.mail.smtplib, "SMTP_SSL", smtp_ssl)
+    return opened
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(yavin.mail.time, "monotonic", clock)
+    return clock
+
+
+def _message(subject: str) -> email.message.EmailMessage:
+    msg = email.message.EmailMessage()
+    msg["Subject"] = subject
+    return msg
+
+
+def test_session_reused(connections: list[FakeSMTP], clock: Clock) -> None:
+    sender = yavin.mail.SMTPSender()
+    first, second = _message("first"), _message("second")
+    sender.send(first, "smtp.example.com", "user", "password")
+    clock.now += 10
+    sender.send(second, "smtp.example.com", "user", "password")
+    assert len(connections) == 1
+    assert connections[0].logins == ["user"]
+    assert connections[0].sent == [first, second]
+
+
+def test_reconnect_after_disconnect(connections: list[FakeSMTP], clock: Clock) -> None:
+    sender = yavin.mail.SMTPSender()
+    sender.send(_message("first"), "smtp.example.com", "user", "password")
+    connections[0].disconnected = True
+    msg = _message("second")
+    sender.send(msg, "smtp.example.com", "user", "password")
+    assert len(connections) == 2
+    assert connections[0].closed
+    assert connections[1].sent == [msg]
+
+
+def test_close_after_idle_timeout(connections: list[FakeSMTP], clock: Clock) -> None:
+    sender = yavin.mail.SMTPSender(idle_timeout=60)
+    sender.send(_message("first"), "smtp.example.com", "user", "password")
+    clock.now += 30
+    sender.close_if_idle()
+    assert not connections[0].closed
+    clock.now += 31
+    sender.close_if_idle()
+    assert connections[0].closed
+    sender.send(_message("second"), "smtp.example.com", "user", "password")
+    assert len(connections) == 2
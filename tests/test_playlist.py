@@ -0,0 +1,126 @@
+import csv
+import pathlib
+import sys
+import time
+from typing import ClassVar
+
+import pytest
+
+import yavin.playlist
+
+
+class StubYTMusic:
+    """Answers album searches from `albums` instead of the network"""
+
+    # Query -> browseId; queries that aren't listed find nothing
+    albums: ClassVar[dict[str, str]] = {}
+    # Query -> seconds to wait before answering
+    delays: ClassVar[dict[str, float]] = {}
+    searches: ClassVar[list[str]] = []
+
+    def search(self, query: str, filter: str) -> list[dict]:
+        self.searches.append(query)
+        time.sleep(self.delays.get(query, 0))
+        if query in self.albums:
+            return [{"browseId": self.albums[query]}]
+        return []
+
+
+@pytest.fixture
+def ytmusic(monkeypatch: pytest.MonkeyPatch) -> type[StubYTMusic]:
+    monkeypatch.setattr(StubYTMusic, "albums", {})
+    monkeypatch.setattr(StubYTMusic, "delays", {})
+    monkeypatch.setattr(StubYTMusic, "searches", [])
+    monkeypatch.setattr(yavin.playlist, "YTMusic", StubYTMusic)
+    return StubYTMusic
+
+
+def _run(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    songs: list[tuple[str, str, str]],
+    *args: str,
+) -> list[list[str]]:
+    """Run the tool on `songs` and return the output rows without the header"""
+    input_path = tmp_path / "playlist.csv"
+    output_path = tmp_path / "out.csv"
+    with input_path.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Song", "Artist", "Album"])
+        writer.writerows(songs)
+    argv = [
+        "playlist",
+        f"--input={input_path}",
+        f"--output={output_path}",
+        f"--cache-path={tmp_path / 'cache.db'}",
+        "--rate=0",
+        *args,
+    ]
+    monkeypatch.setattr(sys, "argv", argv)
+    yavin.playlist.main()
+    with output_path.open(encoding="utf-8", newline="") as f:
+        return list(csv.reader(f))[1:]
+
+
+SONG = ("Golden", "HUNTR/X, EJAE", "KPop Demon Hunters")
+QUERY = "kpop demon hunters huntr/x"
+URL = "https://music.youtube.com/browse/MPREb_golden"
+
+
+def test_cache_hit(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    ytmusic: type[StubYTMusic],
+) -> None:
+    ytmusic.albums[QUERY] = "MPREb_golden"
+    assert _run(tmp_path, monkeypatch, [SONG]) == [[*SONG, URL]]
+    assert ytmusic.searches == [QUERY]
+    assert _run(tmp_path, monkeypatch, [SONG]) == [[*SONG, URL]]
+    assert ytmusic.searches == [QUERY]
+
+
+def test_negative_ttl(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    ytmusic: type[StubYTMusic],
+) -> None:
+    assert _run(tmp_path, monkeypatch, [SONG]) == [[*SONG, ""]]
+    ytmusic.albums[QUERY] = "MPREb_golden"
+    # The miss is cached until it expires
+    assert _run(tmp_path, monkeypatch, [SONG]) == [[*SONG, ""]]
+    assert ytmusic.searches == [QUERY]
+    expired = time.time() + yavin.playlist.NEGATIVE_TTL + 1
+    monkeypatch.setattr(yavin.playlist.time, "time", lambda: expired)
+    assert _run(tmp_path, monkeypatch, [SONG]) == [[*SONG, URL]]
+    assert ytmusic.searches == [QUERY, QUERY]
+
+
+def test_refresh(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    ytmusic: type[StubYTMusic],
+) -> None:
+    ytmusic.albums[QUERY] = "MPREb_golden"
+    _run(tmp_path, monkeypatch, [SONG])
+    ytmusic.albums[QUERY] = "MPREb_golden_deluxe"
+    rows = _run(tmp_path, monkeypatch, [SONG], "--refresh")
+    assert rows == [[*SONG, "https://music.youtube.com/browse/MPREb_golden_deluxe"]]
+    assert ytmusic.searches == [QUERY, QUERY]
+
+
+def test_output_keeps_input_order(
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    ytmusic: type[StubYTMusic],
+) -> None:
+    songs = [(f"Song {i}", f"Artist {i}", f"Album {i}") for i in range(8)]
+    for i in range(8):
+        query = f"album {i} artist {i}"
+        ytmusic.albums[query] = f"MPREb_{i}"
+        # Earlier songs take longer, so lookups finish in reverse order
+        ytmusic.delays[query] = (8 - i) * 0.02
+    rows = _run(tmp_path, monkeypatch, songs, "--workers=4")
+    assert rows == [
+        [*song, f"https://music.youtube.com/browse/MPREb_{i}"]
+        for i, song in enumerate(songs)
+    ]